@@ -1,7 +1,21 @@
+import collections.abc
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import itertools
+import math
 import pathlib
+import shutil
+import sys
+import tempfile
+import zipfile
+import zlib
 
 
+import Bio.SeqIO.FastaIO
 import filelock
+import numpy as np
 
 
 from . import util
@@ -27,45 +41,270 @@ BlastFormat = {
 }
 
 
-class BlastResult:
-    def __init__(self, *values):
-        for (attr, attr_type), value in zip(BlastFormat.items(), values):
-            setattr(self, attr, attr_type(value))
+class HitTable(collections.abc.Mapping):
+    # Hits are stored in a single structured array with each query's hits held contiguously. The table maps
+    # query identifiers to record array slices of their hits, in order of first appearance
+    def __init__(self, hits):
+        hits = hits.view(np.recarray)
+        starts, stops = get_query_bounds(hits.qseqid)
+        if len(set(hits.qseqid[starts])) != len(starts):
+            # Group any non-contiguous query hits, retaining the relative order of queries and hits
+            _, first_indices, inverse = np.unique(hits.qseqid, return_index=True, return_inverse=True)
+            query_ranks = np.argsort(np.argsort(first_indices))
+            hits = hits[np.argsort(query_ranks[inverse], kind='stable')]
+            starts, stops = get_query_bounds(hits.qseqid)
+        self.hits = hits
+        self.queries = hits.qseqid[starts]
+        self._starts = starts
+        self._offsets = dict(zip(self.queries.tolist(), zip(starts.tolist(), stops.tolist())))
 
-    def __str__(self):
-        data_gen = (getattr(self, attr) for attr in BlastFormat)
-        return '\t'.join(str(data) for data in data_gen)
+    def __getitem__(self, qseqid):
+        start, stop = self._offsets[qseqid]
+        return self.hits[start:stop]
 
+    def __iter__(self):
+        return iter(self._offsets)
 
-def run_blastp(query_fp, subject_fp):
+    def __len__(self):
+        return len(self._offsets)
+
+    def best_hits(self):
+        # Select the first hit with the highest pident for each query, matching the tie-breaking of max()
+        if not len(self.hits):
+            return self.hits
+        query_sizes = np.diff(np.append(self._starts, len(self.hits)))
+        pident_max = np.repeat(np.maximum.reduceat(self.hits.pident, self._starts), query_sizes)
+        hit_indices = np.where(self.hits.pident == pident_max, np.arange(len(self.hits)), len(self.hits))
+        return self.hits[np.minimum.reduceat(hit_indices, self._starts)]
+
+
+class SpilledResults(collections.abc.Mapping):
+    # Unfiltered hits written to a compressed TSV and only parsed if accessed e.g. by the troubleshooter
+    def __init__(self):
+        self._dh = tempfile.TemporaryDirectory()
+        self.filepath = pathlib.Path(self._dh.name, 'hits.tsv.gz')
+        self._results = None
+
+    def _load(self):
+        if self._results is None:
+            with gzip.open(self.filepath, 'rt') as fh:
+                self._results = parse_lines(fh)
+        return self._results
+
+    def __getitem__(self, qseqid):
+        return self._load()[qseqid]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+def run_blastp(query_fp, subject_fp, **kwargs):
     # Create a database
     create_blast_database(subject_fp, 'prot')
     # Run alignment
-    command_opts = f'-evalue 0.001 -outfmt \'6 {" ".join(BlastFormat)}\''
-    command_run = f'blastp -db {subject_fp} -query {query_fp} {command_opts}'
-    result = util.execute_command(command_run)
-    if result.stdout != "":
-        return parse_results(result.stdout)
-    else:
-        return {}
+    return run_alignment('blastp', query_fp, subject_fp, **kwargs)
 
 
-def run_blastn(query_fp, subject_fp):
+def run_blastn(query_fp, subject_fp, **kwargs):
     # Create database
     create_blast_database(subject_fp, 'nucl')
     # Run alignment
-    command_opts = f'-evalue 0.001 -outfmt \'6 {" ".join(BlastFormat)}\''
-    command_run = f'blastn -db {subject_fp} -query {query_fp} {command_opts}'
-    result = util.execute_command(command_run)
-    if result.stdout != "":
-        return parse_results(result.stdout)
+    return run_alignment('blastn', query_fp, subject_fp, **kwargs)
+
+
+def run_diamond(query_fp, subject_fp, **kwargs):
+    # Create database
+    create_diamond_database(subject_fp)
+    # Run alignment
+    return run_alignment('diamond', query_fp, subject_fp, **kwargs)
+
+
+# Protein search backends, each taking the arguments of run_blastp and returning hits with BlastFormat columns
+ProteinAligners = {
+    'blast': run_blastp,
+    'diamond': run_diamond,
+}
+
+
+def run_alignment(
+    program,
+    query_fp,
+    subject_fp,
+    *,
+    threads=1,
+    split_query=False,
+    prefilter=False,
+    thresholds=None,
+    spill=None,
+    max_target_seqs=None,
+    dbsize=None,
+):
+    command_opts = get_command_options(program, max_target_seqs=max_target_seqs, dbsize=dbsize)
+    if prefilter and thresholds:
+        command_opts = f'{command_opts} {get_prefilter_options(program, **thresholds)}'
+    with contextlib.ExitStack() as stack:
+        if split_query and threads > 1:
+            # Split query into contiguous chunks and run single-threaded searches on each concurrently; the chunks
+            # retain input order so the merged output is identical to that of a single search
+            dh = stack.enter_context(tempfile.TemporaryDirectory())
+            chunk_fps = split_fasta(query_fp, dh, threads)
+            output_fps = [fp.with_suffix('.tsv') for fp in chunk_fps]
+            commands = list()
+            for chunk_fp, output_fp in zip(chunk_fps, output_fps):
+                commands.append(create_command(program, chunk_fp, subject_fp, 1, command_opts, output_fp=output_fp))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(commands), 1)) as executor:
+                list(executor.map(util.execute_command, commands))
+            lines = itertools.chain.from_iterable(stack.enter_context(fp.open('r')) for fp in output_fps)
+        else:
+            command_run = create_command(program, query_fp, subject_fp, threads, command_opts)
+            lines = util.stream_command(command_run)
+        # Parse results as they are read, optionally writing every hit to disk
+        spill_fh = stack.enter_context(gzip.open(spill.filepath, 'wt', compresslevel=1)) if spill is not None else None
+        return parse_lines(lines, spill_fh=spill_fh, **(thresholds or {}))
+
+
+def create_command(program, query_fp, subject_fp, threads, command_opts, *, output_fp=None):
+    if program == 'diamond':
+        command = f'diamond blastp --db {subject_fp}.dmnd --query {query_fp} --threads {threads} --quiet'
+        output_opt = f'--out {output_fp}' if output_fp else ''
     else:
-        return {}
+        command = f'{program} -db {subject_fp} -query {query_fp} -num_threads {threads}'
+        output_opt = f'-out {output_fp}' if output_fp else ''
+    return f'{command} {command_opts} {output_opt}'.rstrip()
+
+
+def get_command_options(program, *, max_target_seqs=None, dbsize=None):
+    # DIAMOND reports 25 targets per query by default, match the BLAST default of 500 so that both backends
+    # return comparable hit sets
+    if program == 'diamond':
+        options = [f'--evalue 0.001 --outfmt 6 {" ".join(BlastFormat)}', f'--max-target-seqs {max_target_seqs or 500}']
+        if dbsize:
+            options.append(f'--dbsize {dbsize}')
+    else:
+        options = [f'-evalue 0.001 -outfmt \'6 {" ".join(BlastFormat)}\'']
+        if max_target_seqs:
+            options.append(f'-max_target_seqs {max_target_seqs}')
+        if dbsize:
+            options.append(f'-dbsize {dbsize}')
+    return ' '.join(options)
+
+
+def run_alignment_cached(run_search, query_fp, subject_fp, cache_dir, **kwargs):
+    # Unfiltered hits are stored keyed by the search, its input sequences and any options that change output. Thread
+    # and query splitting options only affect runtime so are excluded. Searches must not be prefiltered or thresholded
+    options_key = {k: v for k, v in kwargs.items() if k not in {'threads', 'split_query', 'prefilter'}}
+    hasher = hashlib.sha256(f'{run_search.__name__} {" ".join(BlastFormat)} {sorted(options_key.items())}'.encode())
+    util.hash_file(query_fp, hasher)
+    util.hash_file(subject_fp, hasher)
+    cache_fp = pathlib.Path(cache_dir, f'{hasher.hexdigest()}.npz')
+    try:
+        with np.load(cache_fp) as data:
+            return HitTable(data['hits'])
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, zlib.error) as err:
+        print(f'warning: removing unreadable alignment cache entry {cache_fp}: {err}', file=sys.stderr)
+        cache_fp.unlink(missing_ok=True)
+    results = run_search(query_fp, subject_fp, **kwargs)
+    with util.open_atomic(cache_fp) as fh:
+        np.savez_compressed(fh, hits=results.hits)
+    return results
+
+
+def get_query_bounds(qseqids):
+    boundaries = np.flatnonzero(qseqids[1:] != qseqids[:-1]) + 1
+    starts = np.concatenate(([0], boundaries)) if len(qseqids) else boundaries
+    stops = np.concatenate((boundaries, [len(qseqids)])) if len(qseqids) else boundaries
+    return starts, stops
+
+
+def create_hit_table(columns):
+    # Convert tokenised columns into typed arrays, with string fields sized to their longest value
+    numeric_dtypes = {int: np.int64, float: np.float64}
+    arrays = dict()
+    for (attr, attr_type), column in zip(BlastFormat.items(), columns):
+        arrays[attr] = np.array(column, dtype=str)
+        if attr_type is not str:
+            arrays[attr] = arrays[attr].astype(numeric_dtypes[attr_type])
+    hits = np.empty(len(arrays['qseqid']), dtype=[(attr, array.dtype) for attr, array in arrays.items()])
+    for attr, array in arrays.items():
+        hits[attr] = array
+    return HitTable(hits)
+
+
+def subset_results(results, qseqids):
+    hits = results.hits
+    return HitTable(hits[np.isin(hits.qseqid, list(qseqids))])
+
+
+def relabel_hits(hits, field, labels):
+    # Copy hits into an array with the given field replaced, resizing the field to fit the new labels
+    labels = np.array(labels, dtype=str)
+    dtype = [(attr, labels.dtype if attr == field else hits.dtype[attr]) for attr in hits.dtype.names]
+    hits_relabelled = np.empty(len(hits), dtype=dtype)
+    for attr in hits.dtype.names:
+        hits_relabelled[attr] = labels if attr == field else hits[attr]
+    return HitTable(hits_relabelled)
+
+
+def format_hit(hit):
+    return '\t'.join(str(data) for data in hit.tolist())
+
+
+def get_prefilter_options(program, *, min_coverage=None, min_pident=None, min_ppos=None):
+    # Only apply limits that cannot discard a hit passing filter_results. Identities and positives each consume a
+    # query residue so query coverage is at least coverage * pident and coverage * ppos; subtract a margin for the
+    # rounding of reported values. Target and HSP count limits are not used as they select by evalue, not pident
+    options = list()
+    identity_min = max(min_pident or 0, min_ppos or 0)
+    if min_coverage and identity_min:
+        qcov_hsp_perc = max(min_coverage * (identity_min - 0.01) / 100 - 0.01, 0)
+        qcov_opt = '--query-cover' if program == 'diamond' else '-qcov_hsp_perc'
+        options.append(f'{qcov_opt} {math.floor(qcov_hsp_perc * 100) / 100:.2f}')
+    if program in {'blastn', 'diamond'} and min_pident:
+        pident_opt = '--id' if program == 'diamond' else '-perc_identity'
+        options.append(f'{pident_opt} {max(min_pident - 0.01, 0):.2f}')
+    return ' '.join(options)
+
+
+def split_fasta(fasta_fp, dirpath, chunk_count):
+    # Balance chunks by total sequence length rather than by number of records
+    with fasta_fp.open('r') as fh:
+        records = list(Bio.SeqIO.FastaIO.SimpleFastaParser(fh))
+    residues_total = sum(len(seq) for desc, seq in records)
+    residues_chunk = residues_total / chunk_count
+    chunks = [list()]
+    residues_current = 0
+    for desc, seq in records:
+        if residues_current + len(seq) / 2 > residues_chunk * len(chunks) and len(chunks) < chunk_count:
+            chunks.append(list())
+        chunks[-1].append((desc, seq))
+        residues_current += len(seq)
+    # Write chunks to disk
+    chunk_fps = list()
+    for chunk_n, chunk in enumerate(chunks):
+        if not chunk:
+            continue
+        chunk_fp = pathlib.Path(dirpath, f'{fasta_fp.stem}_{chunk_n}.fasta')
+        with chunk_fp.open('w') as fh:
+            for desc, seq in chunk:
+                print(f'>{desc}', file=fh)
+                print(*[seq[i : i + 80] for i in range(0, len(seq), 80)], sep='\n', file=fh)
+        chunk_fps.append(chunk_fp)
+    return chunk_fps
 
 
 def create_blast_database(subject_fp, db_type):
     # Check if we already have a database
-    database_exts = ['pdb', 'psq', 'pto', 'ptf', 'pot', 'pin', 'phr']
+    if db_type == 'prot':
+        database_exts = ['pdb', 'psq', 'pto', 'ptf', 'pot', 'pin', 'phr']
+    elif db_type == 'nucl':
+        database_exts = ['ndb', 'nsq', 'nto', 'ntf', 'not', 'nin', 'nhr']
+    else:
+        assert False
     database_fps = [pathlib.Path(f'{subject_fp}.{ext}') for ext in database_exts]
     if any(not fp.exists() for fp in database_fps):
         # Create a lock to prevent race condition; multiple concurrent processes could eval to here
@@ -76,29 +315,73 @@ def create_blast_database(subject_fp, db_type):
                 util.execute_command(command_db)
 
 
+def create_diamond_database(subject_fp):
+    database_fp = pathlib.Path(f'{subject_fp}.dmnd')
+    if not database_fp.exists():
+        with filelock.FileLock(f'{subject_fp}.lock', timeout=60):
+            if not database_fp.exists():
+                # Create via a temporary database so that a partially written database is never used
+                database_tmp_fp = pathlib.Path(f'{subject_fp}.tmp.dmnd')
+                command_db = f'diamond makedb --in {subject_fp} --db {database_tmp_fp} --quiet'
+                util.execute_command(command_db)
+                database_tmp_fp.rename(database_fp)
+
+
+def cache_blast_database(fasta_fp, db_type, cache_dir):
+    # Key cached databases by sequence content and database type so that they can be shared between runs
+    hasher = hashlib.sha256(db_type.encode())
+    util.hash_file(fasta_fp, hasher)
+    cached_fp = pathlib.Path(cache_dir, f'{hasher.hexdigest()}_{db_type}.fasta')
+    if not cached_fp.exists():
+        with filelock.FileLock(f'{cached_fp}.lock', timeout=60):
+            if not cached_fp.exists():
+                # Copy via a temporary file so that a partially written FASTA is never visible to other processes
+                cached_tmp_fp = cached_fp.with_suffix('.tmp')
+                shutil.copyfile(fasta_fp, cached_tmp_fp)
+                cached_tmp_fp.rename(cached_fp)
+    create_blast_database(cached_fp, db_type)
+    return cached_fp
+
+
 def filter_results(results, *, min_coverage=None, min_pident=None, min_ppos=None):
-    results_filtered = dict()
-    for hits in results.values():
-        for hit in hits:
-            if min_coverage and hit.length / hit.qlen * 100 < min_coverage:
-                continue
-            if min_pident and hit.pident < min_pident:
-                continue
-            if min_ppos and hit.ppos < min_ppos:
+    hits = results.hits
+    keep = np.ones(len(hits), dtype=bool)
+    if min_coverage:
+        keep &= ~(hits.length / hits.qlen * 100 < min_coverage)
+    if min_pident:
+        keep &= ~(hits.pident < min_pident)
+    if min_ppos:
+        keep &= ~(hits.ppos < min_ppos)
+    return HitTable(hits[keep])
+
+
+def check_thresholds(length, qlen, pident, ppos, min_coverage, min_pident, min_ppos):
+    if min_coverage and length / qlen * 100 < min_coverage:
+        return False
+    if min_pident and pident < min_pident:
+        return False
+    if min_ppos and ppos < min_ppos:
+        return False
+    return True
+
+
+def parse_lines(lines, *, min_coverage=None, min_pident=None, min_ppos=None, spill_fh=None):
+    # Only retain tokens of hits passing thresholds, these are then converted to a hit table
+    field_indices = {attr: i for i, attr in enumerate(BlastFormat)}
+    columns = [list() for _ in BlastFormat]
+    for line in lines:
+        if spill_fh:
+            spill_fh.write(line)
+        line_tokens = line.split()
+        if not line_tokens:
+            continue
+        if min_coverage or min_pident or min_ppos:
+            length = int(line_tokens[field_indices['length']])
+            qlen = int(line_tokens[field_indices['qlen']])
+            pident = float(line_tokens[field_indices['pident']])
+            ppos = float(line_tokens[field_indices['ppos']])
+            if not check_thresholds(length, qlen, pident, ppos, min_coverage, min_pident, min_ppos):
                 continue
-            if hit.qseqid not in results_filtered:
-                results_filtered[hit.qseqid] = list()
-            results_filtered[hit.qseqid].append(hit)
-    return results_filtered
-
-
-def parse_results(results):
-    # pylint: disable=no-member
-    query_hits = dict()
-    line_token_gen = (line.split() for line in results.rstrip().split('\n'))
-    for line_tokens in line_token_gen:
-        hit = BlastResult(*line_tokens)
-        if hit.qseqid not in query_hits:
-            query_hits[hit.qseqid] = list()
-        query_hits[hit.qseqid].append(hit)
-    return query_hits
+        for column, token in zip(columns, line_tokens):
+            column.append(token)
+    return create_hit_table(columns)
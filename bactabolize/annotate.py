@@ -1,4 +1,7 @@
+import concurrent.futures
+import pathlib
 import re
+import sys
 import tempfile
 import os
 
@@ -8,6 +11,7 @@ import Bio.SeqFeature
 import Bio.SeqIO
 import Bio.SeqIO.FastaIO
 import Bio.SeqRecord
+import filelock
 
 
 # Backwards compatible Bio.Alphabet import
@@ -17,41 +21,98 @@ except ImportError:
     bio_alphabet = None
 
 
+# Optional in-process gene prediction
+try:
+    import pyrodigal
+except ImportError:
+    pyrodigal = None
+
+
 from . import util
 
 
-def run(assembly_fp, output_fp):
+def run(assembly_fp, output_fp, *, gene_caller='prodigal', threads=1, training_fp=None):
     # pylint: disable=consider-using-with
     print('\n========================================')
     print('running annotation on ' + os.path.splitext(os.path.basename(assembly_fp))[0])
-    # Check assembly filetype and convert if needed
     dh = tempfile.TemporaryDirectory()
     assembly_filetype = util.determine_assembly_filetype(assembly_fp)
-    if assembly_filetype == 'genbank':
-        assembly_genbank_fp = assembly_fp
-        assembly_fasta_fp = util.write_genbank_seq(assembly_fp, dh.name)
-    elif assembly_filetype == 'fasta':
-        assembly_genbank_fp = None
-        assembly_fasta_fp = assembly_fp
+    assembly_genbank_fp = assembly_fp if assembly_filetype == 'genbank' else None
     print('========================================')
-    prodigal_data = run_prodigal(assembly_fasta_fp)
-    prodigal_orfs = parse_prodigal_output(prodigal_data)
+    if gene_caller == 'prodigal':
+        # Convert assembly to FASTA for prodigal if needed
+        if assembly_filetype == 'genbank':
+            assembly_fasta_fp = util.write_genbank_seq(assembly_fp, dh.name)
+        elif assembly_filetype == 'fasta':
+            assembly_fasta_fp = assembly_fp
+        contigs = read_contigs(assembly_fasta_fp, 'fasta')
+        prodigal_data = run_prodigal(assembly_fasta_fp, training_fp)
+        prodigal_orfs = parse_prodigal_output(prodigal_data)
+    elif gene_caller == 'pyrodigal':
+        contigs = read_contigs(assembly_fp, assembly_filetype)
+        prodigal_orfs = run_pyrodigal(contigs, threads, training_fp)
+    else:
+        assert False
 
     print(f'Found {len(prodigal_orfs)} open-reading frames')
-    genbank_records = create_genbank(prodigal_orfs, assembly_fasta_fp)
-    with output_fp.open('w') as fh:
-        Bio.SeqIO.write(genbank_records, fh, 'genbank')
+    genbank_records = create_genbank(prodigal_orfs, contigs)
 
     # Explicitly remove temporary directory
     dh.cleanup()
 
     # Match ORFs if we have an input genbank
     if assembly_filetype == 'genbank':
-        match_existing_orfs_updated_annotations(output_fp, assembly_genbank_fp)
+        match_existing_orfs_updated_annotations(genbank_records, assembly_genbank_fp)
+
+    # Records are returned for immediate use and written to disk in the background. The write job must be waited on
+    # before the file is read and records must not be modified until then
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    write_job = executor.submit(write_genbank, genbank_records, output_fp)
+    executor.shutdown(wait=False)
+    return genbank_records, write_job
 
 
-def run_prodigal(assembly_fp):
+def write_genbank(genbank_records, output_fp):
+    with output_fp.open('w') as fh:
+        Bio.SeqIO.write(genbank_records, fh, 'genbank')
+
+
+def prepare_training(assembly_fp, training_fp, gene_caller):
+    # Train gene prediction once from a representative assembly for reuse with others of the same species. Training
+    # files are interchangeable between prodigal and pyrodigal. Concurrent runs sharing a training file wait on the
+    # lock so that only one trains
+    if training_fp.exists():
+        return
+    training_fp.parent.mkdir(parents=True, exist_ok=True)
+    with filelock.FileLock(f'{training_fp}.lock'):
+        if training_fp.exists():
+            return
+        print(f'Training {gene_caller} on {assembly_fp}, writing {training_fp}')
+        dh = tempfile.TemporaryDirectory()
+        assembly_filetype = util.determine_assembly_filetype(assembly_fp)
+        # Write via a temporary file so that a partially written training file is never used
+        training_tmp_fp = pathlib.Path(f'{training_fp}.tmp')
+        if gene_caller == 'prodigal':
+            if assembly_filetype == 'genbank':
+                assembly_fasta_fp = util.write_genbank_seq(assembly_fp, dh.name)
+            elif assembly_filetype == 'fasta':
+                assembly_fasta_fp = assembly_fp
+            # Prodigal only trains, writing the training file, when given one that does not exist
+            util.execute_command(f'prodigal -i {assembly_fasta_fp} -m -t {training_tmp_fp} -o /dev/null')
+        elif gene_caller == 'pyrodigal':
+            gene_finder = train_pyrodigal(read_contigs(assembly_fp, assembly_filetype))
+            with training_tmp_fp.open('wb') as fh:
+                gene_finder.training_info.dump(fh)
+        else:
+            assert False
+        training_tmp_fp.rename(training_fp)
+        dh.cleanup()
+
+
+def run_prodigal(assembly_fp, training_fp=None):
     command = f'prodigal -f sco -i {assembly_fp} -m -o /dev/null -d /dev/stdout'
+    if training_fp:
+        command = f'{command} -t {training_fp}'
     result = util.execute_command(command)
     # Prodigal includes \r from FASTAs, causing problems with the output. Remove \r here
     return result.stdout.replace('\r', '')
@@ -68,22 +129,64 @@ def parse_prodigal_output(prodigal_data):
     return orfs
 
 
-def create_genbank(orfs, assembly_fp):
+def run_pyrodigal(contigs, threads, training_fp=None):
+    # Predict genes of each contig concurrently, masking runs of N as with prodigal -m. ORFs are returned in the same
+    # form as parsed prodigal output
+    if training_fp:
+        with training_fp.open('rb') as fh:
+            gene_finder = pyrodigal.GeneFinder(pyrodigal.TrainingInfo.load(fh), mask=True)
+    else:
+        gene_finder = train_pyrodigal(contigs)
+    orfs = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        contig_genes = executor.map(gene_finder.find_genes, contigs.values())
+        for contig_id, genes in zip(contigs, contig_genes):
+            for orf_n, gene in enumerate(genes, 1):
+                partial_str = f'{int(gene.partial_begin)}{int(gene.partial_end)}'
+                orfs.append((contig_id, str(orf_n), str(gene.begin), str(gene.end), str(gene.strand), partial_str))
+    return orfs
+
+
+def train_pyrodigal(contigs):
+    # Train on all contigs together as prodigal does in single mode
+    gene_finder = pyrodigal.GeneFinder(mask=True)
+    try:
+        gene_finder.train(*contigs.values())
+    except ValueError as err:
+        print(f'error: could not train pyrodigal on assembly: {err}', file=sys.stderr)
+        sys.exit(1)
+    return gene_finder
+
+
+def read_contigs(assembly_fp, assembly_filetype):
+    # Contigs are named by genbank record name or the first word of the FASTA description, as prodigal does
+    contigs = dict()
+    with assembly_fp.open('r') as fh:
+        if assembly_filetype == 'genbank':
+            sequences = ((record.name, str(record.seq)) for record in Bio.SeqIO.parse(fh, 'genbank'))
+        elif assembly_filetype == 'fasta':
+            sequences = ((desc.split(' ', maxsplit=1)[0], seq) for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh))
+        else:
+            assert False
+        for contig_id, seq in sequences:
+            assert contig_id not in contigs
+            contigs[contig_id] = seq
+    return contigs
+
+
+def create_genbank(orfs, contigs):
     # pylint: disable=too-many-branches
     # Create unannotated gebnank records
     genbank_records = dict()
-    with assembly_fp.open('r') as fh:
-        for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh):
-            contig_id = desc.split(' ', maxsplit=1)[0]
-            assert contig_id not in genbank_records
-            # Backwards compatiblity Seq init
-            if bio_alphabet:
-                sequence_record = Bio.Seq.Seq(''.join(seq), bio_alphabet)
-            else:
-                sequence_record = Bio.Seq.Seq(''.join(seq))
-            genbank_records[contig_id] = Bio.SeqRecord.SeqRecord(
-                seq=sequence_record, id=contig_id, name=contig_id, annotations={'molecule_type': 'DNA'}
-            )
+    for contig_id, seq in contigs.items():
+        # Backwards compatiblity Seq init. Sequence is uppercase as when read from genbank
+        if bio_alphabet:
+            sequence_record = Bio.Seq.Seq(seq.upper(), bio_alphabet)
+        else:
+            sequence_record = Bio.Seq.Seq(seq.upper())
+        genbank_records[contig_id] = Bio.SeqRecord.SeqRecord(
+            seq=sequence_record, id=contig_id, name=contig_id, annotations={'molecule_type': 'DNA'}
+        )
     # Annotate records with prodigal ORFs
     for contig, orf_n, posl_str, posr_str, strand_str, partial_str in orfs:
         if strand_str == '1':
@@ -92,7 +195,7 @@ def create_genbank(orfs, assembly_fp):
             strand = -1
         else:
             assert False
-        quals = {'gene': orf_n, 'locus_tag': orf_n, 'note': get_qual_note(partial_str)}
+        quals = {'gene': [orf_n], 'locus_tag': [orf_n], 'note': [get_qual_note(partial_str)]}
         feature_loc = Bio.SeqFeature.FeatureLocation(start=int(posl_str) - 1, end=int(posr_str), strand=strand)
         feature = Bio.SeqFeature.SeqFeature(location=feature_loc, type='CDS', qualifiers=quals)
         genbank_records[contig].features.append(feature)
@@ -113,10 +216,11 @@ def get_qual_note(partial_str):
     return note
 
 
-def match_existing_orfs_updated_annotations(new_fp, existing_fp, overlap_min=0.80):
+def match_existing_orfs_updated_annotations(genbank_records, existing_fp, overlap_min=0.80):
     # Get features and create list of start and end objects for each
-    features_new = collect_all_features(new_fp)
-    features_existing = collect_all_features(existing_fp)
+    features_new = collect_all_features(genbank_records)
+    with existing_fp.open('r') as fh:
+        features_existing = collect_all_features(Bio.SeqIO.parse(fh, 'genbank'))
     contig_positions_new = create_positions(features_new, 'new')
     contig_positions_existing = create_positions(features_existing, 'existing')
 
@@ -127,20 +231,13 @@ def match_existing_orfs_updated_annotations(new_fp, existing_fp, overlap_min=0.8
         positions = contig_positions_new[contig] + contig_positions_existing[contig]
         features_matched = discover_overlaps(positions, overlap_min)
         
-        # Discover those not matched using location comparison
-        features_matched_new = [f[0] for f in features_matched]
-        features_matched_existing = [f[1] for f in features_matched]
-        
         # Find unmatched features by comparing locations
-        new_unmatched = []
-        for feature in features_new[contig]:
-            if not any(f.location == feature.location for f in features_matched_new):
-                new_unmatched.append(feature)
-                
-        existing_unmatched = []
-        for feature in features_existing[contig]:
-            if not any(f.location == feature.location for f in features_matched_existing):
-                existing_unmatched.append(feature)
+        locations_matched_new = {get_location_key(f[0].location) for f in features_matched}
+        locations_matched_existing = {get_location_key(f[1].location) for f in features_matched}
+        new_unmatched = [f for f in features_new[contig] if get_location_key(f.location) not in locations_matched_new]
+        existing_unmatched = [
+            f for f in features_existing[contig] if get_location_key(f.location) not in locations_matched_existing
+        ]
 
         # For each matched update bounds update locus tag, product, gene (if present) to match existing
         quals = ('locus_tag', 'product', 'gene')
@@ -164,15 +261,15 @@ def match_existing_orfs_updated_annotations(new_fp, existing_fp, overlap_min=0.8
         print(f'\t{len(new_unmatched)} re-annotated features unmatched')
         print(f'\t{len(features_updated)} total features')
         
-    # Update new genbank with new feature set
-    update_genbank_annotations(new_fp, contig_features_updated)
+    # Update new genbank records with new feature set
+    for record in genbank_records:
+        record.features = contig_features_updated[record.name]
 
 
-def collect_all_features(fp):
+def collect_all_features(records):
     features = dict()
-    with fp.open('r') as fh:
-        for record in Bio.SeqIO.parse(fh, 'genbank'):
-            features[record.name] = list(util.iterate_coding_features(record))
+    for record in records:
+        features[record.name] = list(util.iterate_coding_features(record))
     return features
 
 
@@ -188,58 +285,50 @@ def create_positions(contig_features, source):
 
 
 def discover_overlaps(positions, overlap_min):
-    # pylint: disable=too-many-branches
-    in_new = list()
-    in_existing = list()
-    # Change from set to list to store matches
-    features_matched = []
+    # Sweep across feature boundaries tracking the features we are within. A pair of features can only be first
+    # compared once both have been entered, so only pairs with the feature just entered are compared. Matched pairs
+    # are recorded by location so that a pair sharing locations with an already matched pair is not matched again
+    in_new = dict()
+    in_existing = dict()
+    features_matched = list()
+    locations_matched = set()
     for position in sorted(positions, key=lambda k: k['position']):
-        # Add features we're entering and remove those we're exiting
-        if position['type'] == 'start':
-            if position['source'] == 'new':
-                in_new.append(position['feature'])
-            elif position['source'] == 'existing':
-                in_existing.append(position['feature'])
-        elif position['type'] == 'end':
-            if position['source'] == 'new':
-                in_new.remove(position['feature'])
-            elif position['source'] == 'existing':
-                in_existing.remove(position['feature'])
-        if not (in_new and in_existing):
+        feature = position['feature']
+        in_source = in_new if position['source'] == 'new' else in_existing
+        # Remove features we're exiting and add those we're entering
+        if position['type'] == 'end':
+            del in_source[id(feature)]
             continue
+        in_source[id(feature)] = feature
+        if position['source'] == 'new':
+            feature_pairs = [(feature, feature_existing) for feature_existing in in_existing.values()]
+        else:
+            feature_pairs = [(feature_new, feature) for feature_new in in_new.values()]
         # Iterate new/existing features that overlap
-        for feature_new in in_new:
-            for feature_existing in in_existing:
-                if feature_new.strand != feature_existing.strand:
-                    continue
-                # Check if this pair is already matched by comparing locations
-                already_matched = any(
-                    fn.location == feature_new.location and fe.location == feature_existing.location 
-                    for fn, fe in features_matched
-                )
-                if already_matched:
-                    continue
-                # Get overlap
-                start = max(feature_new.location.start, feature_existing.location.start)
-                end = min(feature_new.location.end, feature_existing.location.end)
-                overlap_count = end - start
-                overlap_new = overlap_count / len(feature_new)
-                overlap_existing = overlap_count / len(feature_existing)
-                # Record if overlap over threshold
-                if overlap_new > overlap_min and overlap_existing > overlap_min:
-                    # Update note to include overlap information
-                    [note_new] = feature_new.qualifiers['note']
-                    feature_new.qualifiers['note'][0] = f'{note_new};overlap:{overlap_new:.2f}'
-                    features_matched.append((feature_new, feature_existing))
+        for feature_new, feature_existing in feature_pairs:
+            if feature_new.strand != feature_existing.strand:
+                continue
+            location_pair = (get_location_key(feature_new.location), get_location_key(feature_existing.location))
+            if location_pair in locations_matched:
+                continue
+            # Get overlap
+            start = max(feature_new.location.start, feature_existing.location.start)
+            end = min(feature_new.location.end, feature_existing.location.end)
+            overlap_count = end - start
+            overlap_new = overlap_count / len(feature_new)
+            overlap_existing = overlap_count / len(feature_existing)
+            # Record if overlap over threshold
+            if overlap_new > overlap_min and overlap_existing > overlap_min:
+                # Update note to include overlap information
+                [note_new] = feature_new.qualifiers['note']
+                feature_new.qualifiers['note'][0] = f'{note_new};overlap:{overlap_new:.2f}'
+                features_matched.append((feature_new, feature_existing))
+                locations_matched.add(location_pair)
     return features_matched
 
 
-def update_genbank_annotations(filepath, features_updated):
-    # Read in data then update
-    with filepath.open('r') as fh:
-        records = {record.name: record for record in Bio.SeqIO.parse(fh, 'genbank')}
-    for contig, record in records.items():
-        record.features = features_updated[contig]
-    # Write
-    with filepath.open('w') as fh:
-        Bio.SeqIO.write(records.values(), fh, 'genbank')
+def get_location_key(location):
+    # Hashable key that is equal for equal locations
+    if isinstance(location, Bio.SeqFeature.CompoundLocation):
+        return (location.operator, tuple(get_location_key(part) for part in location.parts))
+    return (int(location.start), int(location.end), location.strand, location.ref, location.ref_db)
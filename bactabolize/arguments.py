@@ -1,4 +1,6 @@
 import argparse
+import importlib.util
+import math
 import pathlib
 import sys
 
@@ -40,22 +42,27 @@ def parse():
 
     parser_draft = subparsers.add_parser('draft_model', add_help=False)
     parser_draft.add_argument('--assembly_fp', type=pathlib.Path)
-    parser_draft.add_argument('--ref_genbank_fp', type=pathlib.Path)
-    parser_draft.add_argument('--ref_proteins_fp', type=pathlib.Path)
-    parser_draft.add_argument('--ref_genes_fp', type=pathlib.Path)
-    parser_draft.add_argument('--ref_model_fp', type=pathlib.Path)
-    parser_draft.add_argument('--min_coverage', type=float, default=25)
-    parser_draft.add_argument('--min_pident', type=float, default=80)
-    parser_draft.add_argument('--min_ppos', type=float)
-    parser_draft.add_argument(
-        '--media_type', type=str, default='m9', choices=package_data.available('media_definitions')
-    )
-    parser_draft.add_argument('--atmosphere_type', type=str, choices=['aerobic', 'anaerobic'])
-    parser_draft.add_argument('--biomass_reaction_id', type=str, default='BIOMASS_')
     parser_draft.add_argument('--output_fp', type=pathlib.Path)
     parser_draft.add_argument('--memote_report_fp', type=pathlib.Path)
-    parser_draft.add_argument('--no_reannotation', action='store_true')
-    parser_draft.add_argument('-h', '--help', action='store_true')
+    add_draft_model_arguments(parser_draft)
+
+    parser_batch = subparsers.add_parser('draft_model_batch', add_help=False)
+    parser_batch.add_argument('--assembly_list_fp', type=pathlib.Path)
+    parser_batch.add_argument('--assembly_glob', type=str)
+    parser_batch.add_argument('--output_dir', type=pathlib.Path)
+    parser_batch.add_argument('--workers', type=int, default=1)
+    parser_batch.set_defaults(assembly_fp=None, output_fp=None, memote_report_fp=None)
+    add_draft_model_arguments(parser_batch)
+
+    parser_reference = subparsers.add_parser('prepare_reference', add_help=False)
+    parser_reference.add_argument('--ref_genbank_fp', type=pathlib.Path)
+    parser_reference.add_argument('--ref_proteins_fp', type=pathlib.Path)
+    parser_reference.add_argument('--ref_genes_fp', type=pathlib.Path)
+    parser_reference.add_argument('--ref_model_fp', type=pathlib.Path)
+    parser_reference.add_argument('--aligner', type=str, default='blast', choices=['blast', 'diamond'])
+    parser_reference.add_argument('--output_dir', type=pathlib.Path)
+    parser_reference.add_argument('-h', '--help', action='store_true')
+    parser_reference.set_defaults(output_fp=None)
 
     parser_patch = subparsers.add_parser('patch_model', add_help=False)
     parser_patch.add_argument('--draft_model_fp', type=pathlib.Path)
@@ -66,8 +73,13 @@ def parse():
     )
     parser_patch.add_argument('--atmosphere_type', type=str, choices=['aerobic', 'anaerobic'])
     parser_patch.add_argument('--output_fp', type=pathlib.Path)
+    parser_patch.add_argument(
+        '--output_formats', type=str, nargs='+', default=['json', 'sbml'], choices=['json', 'sbml']
+    )
     parser_patch.add_argument('--biomass_reaction_id', type=str, default='BIOMASS_')
     parser_patch.add_argument('--memote_report_fp', type=pathlib.Path)
+    parser_patch.add_argument('--model_cache', type=pathlib.Path)
+    parser_patch.add_argument('--model_cache_size', type=int, default=1024)
     parser_patch.add_argument('-h', '--help', action='store_true')
 
     parser_fba = subparsers.add_parser('fba', add_help=False)
@@ -76,6 +88,8 @@ def parse():
     parser_fba.add_argument('--fba_spec_fp', type=pathlib.Path)
     parser_fba.add_argument('--fba_spec_name', type=str, choices=package_data.available('fba_specs'))
     parser_fba.add_argument('--output_fp', type=pathlib.Path)
+    parser_fba.add_argument('--model_cache', type=pathlib.Path)
+    parser_fba.add_argument('--model_cache_size', type=int, default=1024)
     parser_fba.add_argument('-h', '--help', action='store_true')
 
     parser_sgk = subparsers.add_parser('sgk', add_help=False)
@@ -83,6 +97,8 @@ def parse():
     parser_sgk.add_argument('--media_type', type=str, default='m9', choices=package_data.available('media_definitions'))
     parser_sgk.add_argument('--atmosphere_type', type=str, choices=['aerobic', 'anaerobic'])
     parser_sgk.add_argument('--output_fp', type=pathlib.Path)
+    parser_sgk.add_argument('--model_cache', type=pathlib.Path)
+    parser_sgk.add_argument('--model_cache_size', type=int, default=1024)
     parser_sgk.add_argument('-h', '--help', action='store_true')
 
     args = parser.parse_args()
@@ -90,6 +106,40 @@ def parse():
     return args
 
 
+def add_draft_model_arguments(parser):
+    parser.add_argument('--ref_genbank_fp', type=pathlib.Path)
+    parser.add_argument('--ref_proteins_fp', type=pathlib.Path)
+    parser.add_argument('--ref_genes_fp', type=pathlib.Path)
+    parser.add_argument('--ref_model_fp', type=pathlib.Path)
+    parser.add_argument('--ref_bundle', type=pathlib.Path)
+    parser.add_argument('--min_coverage', type=float, default=25)
+    parser.add_argument('--min_pident', type=float, default=80)
+    parser.add_argument('--min_ppos', type=float)
+    parser.add_argument('--threshold_grid', type=str, nargs='+')
+    parser.add_argument('--threshold_grid_models', type=int, nargs='+', default=list())
+    parser.add_argument('--media_type', type=str, default='m9', choices=package_data.available('media_definitions'))
+    parser.add_argument('--atmosphere_type', type=str, choices=['aerobic', 'anaerobic'])
+    parser.add_argument('--biomass_reaction_id', type=str, default='BIOMASS_')
+    parser.add_argument('--output_formats', type=str, nargs='+', default=['json', 'sbml'], choices=['json', 'sbml'])
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--gapfill_timeout', type=float)
+    parser.add_argument('--gapfill_universal', type=str, default='full', choices=['full', 'evidence'])
+    parser.add_argument('--aligner', type=str, default='blast', choices=['blast', 'diamond'])
+    parser.add_argument('--blast_split_query', action='store_true')
+    parser.add_argument('--blast_db_cache', type=pathlib.Path)
+    parser.add_argument('--alignment_cache', type=pathlib.Path)
+    parser.add_argument('--model_cache', type=pathlib.Path)
+    parser.add_argument('--model_cache_size', type=int, default=1024)
+    parser.add_argument('--blast_prefilter', action='store_true')
+    parser.add_argument('--exact_match_orthologs', action='store_true')
+    parser.add_argument('--no_reannotation', action='store_true')
+    parser.add_argument('--gene_caller', type=str, default='prodigal', choices=['prodigal', 'pyrodigal'])
+    parser.add_argument('--prodigal_training_fp', type=pathlib.Path)
+    parser.add_argument('--prodigal_training_label', type=str)
+    parser.add_argument('--prodigal_training_cache', type=pathlib.Path)
+    parser.add_argument('-h', '--help', action='store_true')
+
+
 def check_arguments(args):
     # pylint: disable=no-else-continue,too-many-branches,too-many-statements
     if args.help:
@@ -109,6 +159,23 @@ def check_arguments(args):
             ),
             'all': (('ref_proteins_fp', 'ref_genes_fp'),),
         },
+        'draft_model_batch': {
+            'single': ('ref_model_fp', 'output_dir'),
+            'exactly_one': (
+                ('assembly_list_fp', 'assembly_glob'),
+                ('ref_genbank_fp', 'ref_proteins_fp'),
+                ('ref_genbank_fp', 'ref_genes_fp'),
+            ),
+            'all': (('ref_proteins_fp', 'ref_genes_fp'),),
+        },
+        'prepare_reference': {
+            'single': ('ref_model_fp', 'output_dir'),
+            'exactly_one': (
+                ('ref_genbank_fp', 'ref_proteins_fp'),
+                ('ref_genbank_fp', 'ref_genes_fp'),
+            ),
+            'all': (('ref_proteins_fp', 'ref_genes_fp'),),
+        },
         'patch_model': {
             'single': ('draft_model_fp', 'ref_model_fp', 'patch_fp', 'output_fp'),
         },
@@ -121,6 +188,21 @@ def check_arguments(args):
         },
     }
 
+    # A reference bundle replaces all other reference inputs
+    if 'ref_bundle' in args and args.ref_bundle:
+        ref_args = ('ref_genbank_fp', 'ref_proteins_fp', 'ref_genes_fp', 'ref_model_fp')
+        ref_args_present = [f'--{arg}' for arg in ref_args if args.__dict__[arg] is not None]
+        if ref_args_present:
+            ref_args_present_str = ', '.join(ref_args_present)
+            msg = f'{__program_name__}: error: --ref_bundle cannot be used with {ref_args_present_str}'
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+        required_args['draft_model'] = {'single': ('assembly_fp', 'output_fp')}
+        required_args['draft_model_batch'] = {
+            'single': ('output_dir',),
+            'exactly_one': (('assembly_list_fp', 'assembly_glob'),),
+        }
+
     if not args.command:
         msg = f'{__program_name__}: error: you must provide a command to execute'
         print(help_text(args.command), file=sys.stderr)
@@ -170,18 +252,128 @@ def check_arguments(args):
             print('\t', msg, sep='', file=sys.stderr)
         sys.exit(1)
 
-    # Check all input file objects exist
+    # Check thread count is sensible
+    if 'threads' in args and args.threads < 1:
+        print(f'{__program_name__}: error: --threads must be at least 1', file=sys.stderr)
+        sys.exit(1)
+    if 'model_cache_size' in args and args.model_cache_size < 1:
+        print(f'{__program_name__}: error: --model_cache_size must be at least 1', file=sys.stderr)
+        sys.exit(1)
+    if 'gapfill_timeout' in args and args.gapfill_timeout is not None and args.gapfill_timeout <= 0:
+        print(f'{__program_name__}: error: --gapfill_timeout must be greater than 0', file=sys.stderr)
+        sys.exit(1)
+    if 'workers' in args and args.workers < 1:
+        print(f'{__program_name__}: error: --workers must be at least 1', file=sys.stderr)
+        sys.exit(1)
+
+    # Reference BLAST databases are not used by other aligners
+    if 'blast_db_cache' in args and args.blast_db_cache and args.aligner != 'blast':
+        print(f'{__program_name__}: error: --blast_db_cache requires --aligner blast', file=sys.stderr)
+        sys.exit(1)
+
+    # Check optional gene caller is available
+    if 'gene_caller' in args and args.gene_caller == 'pyrodigal' and not importlib.util.find_spec('pyrodigal'):
+        print(f'{__program_name__}: error: --gene_caller pyrodigal requires the pyrodigal package', file=sys.stderr)
+        sys.exit(1)
+
+    # Check and resolve prodigal training file, labelled training files are named by label in the cache directory
+    if 'prodigal_training_fp' in args:
+        training_args = ('prodigal_training_fp', 'prodigal_training_label', 'prodigal_training_cache')
+        training_args_present = [f'--{arg}' for arg in training_args if args.__dict__[arg] is not None]
+        if training_args_present and args.no_reannotation:
+            msg = f'{", ".join(training_args_present)} cannot be used with --no_reannotation'
+            print(f'{__program_name__}: error: {msg}', file=sys.stderr)
+            sys.exit(1)
+        if args.prodigal_training_fp and (args.prodigal_training_label or args.prodigal_training_cache):
+            msg = '--prodigal_training_fp cannot be used with --prodigal_training_label or --prodigal_training_cache'
+            print(f'{__program_name__}: error: {msg}', file=sys.stderr)
+            sys.exit(1)
+        if bool(args.prodigal_training_label) != bool(args.prodigal_training_cache):
+            msg = '--prodigal_training_label and --prodigal_training_cache must be used together'
+            print(f'{__program_name__}: error: {msg}', file=sys.stderr)
+            sys.exit(1)
+        if args.prodigal_training_label:
+            training_name = args.prodigal_training_label.replace(' ', '_')
+            if pathlib.Path(training_name).name != training_name:
+                msg = f'--prodigal_training_label got {args.prodigal_training_label}, cannot contain a path separator'
+                print(f'{__program_name__}: error: {msg}', file=sys.stderr)
+                sys.exit(1)
+            args.prodigal_training_fp = args.prodigal_training_cache / f'{training_name}.trn'
+
+    # Check and parse threshold grid
+    if 'threshold_grid' in args:
+        if args.threshold_grid:
+            try:
+                args.threshold_grid = parse_threshold_grid(args.threshold_grid)
+            except ValueError as err:
+                print(f'{__program_name__}: error: {err}', file=sys.stderr)
+                sys.exit(1)
+        point_count = math.prod(len(values) for name, values in args.threshold_grid or list())
+        if args.threshold_grid_models and not args.threshold_grid:
+            print(f'{__program_name__}: error: --threshold_grid_models requires --threshold_grid', file=sys.stderr)
+            sys.exit(1)
+        if any(point < 1 or point > point_count for point in args.threshold_grid_models):
+            msg = f'{__program_name__}: error: --threshold_grid_models must be grid points between 1 and {point_count}'
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+    # Prefiltering is not applied where unfiltered alignments are required
+    if 'blast_prefilter' in args and args.blast_prefilter:
+        prefilter_excluded = list()
+        if args.command == 'draft_model_batch':
+            prefilter_excluded.append(args.command)
+        if args.threshold_grid:
+            prefilter_excluded.append('--threshold_grid')
+        if args.alignment_cache:
+            prefilter_excluded.append('--alignment_cache')
+        if prefilter_excluded:
+            msg = f'--blast_prefilter is not applied with {", ".join(prefilter_excluded)}'
+            print(f'{__program_name__}: warning: {msg}', file=sys.stderr)
+
+    # Check all input file objects exist, excluding outputs and those created if absent
+    args_created = {
+        'output_fp',
+        'memote_report_fp',
+        'blast_db_cache',
+        'alignment_cache',
+        'model_cache',
+        'prodigal_training_fp',
+        'prodigal_training_cache',
+    }
     for arg, value in args.__dict__.items():
-        if not value or arg in {'output_fp', 'memote_report_fp'}:
+        if not value or arg in args_created:
+            continue
+        elif arg == 'output_dir' and args.command == 'prepare_reference':
             continue
         elif isinstance(value, pathlib.Path):
             if not value.exists():
                 print(f'{__program_name__}: error: input {value} does not exist', file=sys.stderr)
                 sys.exit(1)
     # Check that output directory in output filepath exists
-    if not args.output_fp.parent.exists():
+    if args.output_fp and not args.output_fp.parent.exists():
         print(f'Output directory {args.output_fp.parent} for --output_fp does not exist', file=sys.stderr)
         sys.exit(1)
+    if args.command == 'draft_model_batch' and not args.output_dir.is_dir():
+        print(f'Output directory {args.output_dir} for --output_dir is not a directory', file=sys.stderr)
+        sys.exit(1)
+
+
+def parse_threshold_grid(threshold_grid):
+    # Grid thresholds are given as <name>=<value>[,<value>...] e.g. min_pident=70,80
+    threshold_names = ('min_coverage', 'min_pident', 'min_ppos')
+    threshold_values = dict()
+    for threshold_str in threshold_grid:
+        name, _, values_str = threshold_str.partition('=')
+        if name not in threshold_names:
+            threshold_names_str = ', '.join(threshold_names)
+            raise ValueError(f'--threshold_grid got {threshold_str}, must be one of {threshold_names_str}')
+        if name in threshold_values:
+            raise ValueError(f'--threshold_grid got {name} more than once')
+        try:
+            threshold_values[name] = [float(value) for value in values_str.split(',')]
+        except ValueError:
+            raise ValueError(f'--threshold_grid got {threshold_str}, values must be numbers') from None
+    return list(threshold_values.items())
 
 
 def help_text(command):
@@ -194,6 +386,8 @@ def help_text(command):
             f'Usage: {__program_name__} <command> [options]\n\n'
             'Commands:\n'
             '  draft_model                 Create a draft model\n'
+            '  draft_model_batch           Create draft models for many assemblies\n'
+            '  prepare_reference           Prepare a reference bundle for reuse across draft model runs\n'
             '  patch_model                 Patch a draft model\n'
             '  fba                         Simulate growth on media with FBA\n'
             '  sgk                         Perform single gene knockout\n\n'
@@ -208,9 +402,13 @@ def help_text(command):
             '  --ref_proteins_fp FILE      Reference proteins filepath (FASTA)\n'
             '  --ref_genes_fp FILE         Reference genes filepath (FASTA)\n'
             '  --ref_model_fp FILE         Reference model filepath (JSON, XML [SMBL v3.1])\n'
+            '  --ref_bundle DIR            Reference bundle from prepare_reference, replaces other reference inputs\n'
             '  --min_coverage FLOAT        Alignment minimum coverage [default: 25]\n'
             '  --min_pident FLOAT          Alignment minimum percentage identity [default: 80]\n'
             '  --min_ppos FLOAT            Alignment minimum percentage positive matches\n'
+            '  --threshold_grid STR        Evaluate draft models over a grid of alignment thresholds, aligning once\n'
+            '                              [e.g. min_pident=70,80 min_coverage=25,50]\n'
+            '  --threshold_grid_models INT Grid points to write full draft models for [default: none]\n'
             '  --media_type STR            Media type used to validate model '
             f'[choices: {media_choices}] [default: m9]\n'
             '  --atmosphere_type STR       Atmosphere type used to validate model '
@@ -218,8 +416,63 @@ def help_text(command):
             '  --biomass_reaction_id STR   Identifier of the biomass reaction [default: BIOMASS_]\n'
             '  --memote_report_fp FILE     MEMOTE report output filepath\n'
             '  --output_fp FILE            Output filepath\n'
+            '  --output_formats STR        Model output formats, written while the model is assessed\n'
+            '                              [choices: json, sbml] [default: json sbml]\n'
             '\nOther:\n'
+            '  --threads INT               Number of threads to use for alignment and concurrent gapfilling\n'
+            '                              attempts of the troubleshooter [default: 1]\n'
+            '  --gapfill_timeout FLOAT     Maximum seconds for each troubleshooter gapfilling attempt\n'
+            '  --gapfill_universal STR     Reference reactions the troubleshooter gapfills from, evidence limits\n'
+            '                              these to reactions without genes or with a gene having any alignment hit\n'
+            '                              and falls back to all should gapfilling fail [choices: full, evidence]\n'
+            '                              [default: full]\n'
+            '  --aligner STR               Protein alignment software, DIAMOND is faster but less sensitive\n'
+            '                              [choices: blast, diamond] [default: blast]\n'
+            '  --blast_split_query         Split BLAST queries into chunks run concurrently, one per thread\n'
+            '  --blast_db_cache DIR        Directory to store and reuse reference BLAST databases\n'
+            '  --alignment_cache DIR       Directory to store and reuse unfiltered alignments, allowing re-runs\n'
+            '                              with different thresholds without realigning\n'
+            '  --model_cache DIR           Directory to store and reuse parsed models\n'
+            '  --model_cache_size INT      Maximum model cache size in MB [default: 1024]\n'
+            '  --blast_prefilter           Apply alignment thresholds within BLAST where lossless for orthologs,\n'
+            '                              troubleshooter BLAST output then omits the prefiltered hits. Not applied\n'
+            '                              with --threshold_grid, --alignment_cache or by draft_model_batch, which\n'
+            '                              require unfiltered alignments\n'
+            '  --exact_match_orthologs     Assign uniquely identical proteins as orthologs prior to BLAST\n'
             '  --no_reannotation           Do not reannotate genbank file\n'
+            '  --gene_caller STR           Gene prediction software for reannotation, pyrodigal runs in-process\n'
+            '                              using --threads [choices: prodigal, pyrodigal] [default: prodigal]\n'
+            '  --prodigal_training_fp FILE Gene prediction training file, created from the assembly if it does not\n'
+            '                              exist then reused for others of the same species\n'
+            '  --prodigal_training_label STR\n'
+            '                              Species or other label naming a training file in the training cache\n'
+            '  --prodigal_training_cache DIR\n'
+            '                              Directory to store and reuse labelled training files\n'
+        )
+    elif command == 'draft_model_batch':
+        help_text_str = (
+            f'Usage: {__program_name__} {command} [options]\n'
+            'Options:\n'
+            '  --assembly_list_fp FILE     File listing isolate assembly filepaths, one per line\n'
+            '  --assembly_glob STR         Glob matching isolate assembly filepaths, quote to avoid shell expansion\n'
+            '  --output_dir DIR            Output directory\n'
+            '  --workers INT               Number of isolates to process concurrently [default: 1]\n'
+            '\nAll draft_model options other than --assembly_fp, --output_fp and --memote_report_fp are also\n'
+            'accepted. Proteins shared between assemblies are aligned to the reference only once. Thread count\n'
+            'is shared between workers for per-isolate annotation, alignment and gapfilling.\n'
+        )
+    elif command == 'prepare_reference':
+        help_text_str = (
+            f'Usage: {__program_name__} {command} [options]\n'
+            'Options:\n'
+            '  --ref_genbank_fp FILE       Reference genbank filepath\n'
+            '  --ref_proteins_fp FILE      Reference proteins filepath (FASTA)\n'
+            '  --ref_genes_fp FILE         Reference genes filepath (FASTA)\n'
+            '  --ref_model_fp FILE         Reference model filepath (JSON, XML [SMBL v3.1])\n'
+            '  --aligner STR               Protein alignment software to create a database for\n'
+            '                              [choices: blast, diamond] [default: blast]\n'
+            '  --output_dir DIR            Output bundle directory, created if needed\n'
+            '\nThe bundle is used with draft_model --ref_bundle in place of other reference inputs.\n'
         )
     elif command == 'patch_model':
         help_text_str = (
@@ -235,6 +488,11 @@ def help_text(command):
             '  --biomass_reaction_id STR   Identifier of the biomass reaction [default: BIOMASS_]\n'
             '  --memote_report_fp FILE     MEMOTE report output filepath\n'
             '  --output_fp FILE            Output filepath\n'
+            '  --output_formats STR        Model output formats, written while the model is assessed\n'
+            '                              [choices: json, sbml] [default: json sbml]\n'
+            '\nOther:\n'
+            '  --model_cache DIR           Directory to store and reuse parsed models\n'
+            '  --model_cache_size INT      Maximum model cache size in MB [default: 1024]\n'
         )
     elif command == 'fba':
         help_text_str = (
@@ -245,6 +503,9 @@ def help_text(command):
             '  --fba_spec_fp FILE          Custom FBA spec filepath (JSON, XML [SMBL v3.1])\n'
             f'  --fba_spec_name STR         Prepackaged FBA spec name [choices: {fba_spec_choices}]\n'
             '  --output_fp FILE            Output filepath\n'
+            '\nOther:\n'
+            '  --model_cache DIR           Directory to store and reuse parsed models\n'
+            '  --model_cache_size INT      Maximum model cache size in MB [default: 1024]\n'
         )
     elif command == 'sgk':
         help_text_str = (
@@ -256,6 +517,9 @@ def help_text(command):
             '  --atmosphere_type STR       Atmosphere type used to validate model '
             '[choices: aerobic, anaerobic]\n'
             '  --output_fp FILE            Output filepath\n'
+            '\nOther:\n'
+            '  --model_cache DIR           Directory to store and reuse parsed models\n'
+            '  --model_cache_size INT      Maximum model cache size in MB [default: 1024]\n'
         )
     else:
         assert False
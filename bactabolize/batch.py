@@ -0,0 +1,299 @@
+import concurrent.futures
+import copy
+import functools
+import glob
+import multiprocessing
+import multiprocessing.connection
+import pathlib
+import sys
+import tempfile
+import time
+import traceback
+
+
+import Bio.SeqIO.FastaIO
+import numpy as np
+
+
+from . import alignment
+from . import annotate
+from . import draft_model
+from . import util
+
+
+# Isolate configurations and alignments are placed here prior to starting worker processes, which are forked so that
+# these along with the reference model are shared in copy-on-write memory rather than being sent to each worker
+_worker_state = dict()
+
+
+def run(config):
+    # pylint: disable=consider-using-with
+    print('\n========================================')
+    print('running batch draft model creation')
+    print('========================================')
+    dh = tempfile.TemporaryDirectory()
+    assembly_fps = collect_assemblies(config)
+    # Prepare reference once, this is shared by all isolates
+    draft_model.prepare_reference(config, dh.name)
+    isolate_configs = list()
+    for assembly_fp in assembly_fps:
+        isolate_config = copy.copy(config)
+        isolate_config.assembly_fp = assembly_fp
+        isolate_config.output_fp = config.output_dir / f'{assembly_fp.stem}.json'
+        # Share threads between workers for per-isolate annotation, alignment and gapfilling
+        isolate_config.threads = max(config.threads // config.workers, 1)
+        isolate_config.alignment_options = {**config.alignment_options, 'threads': isolate_config.threads}
+        isolate_config.gapfill_options = {**config.gapfill_options, 'processes': isolate_config.threads}
+        isolate_configs.append(isolate_config)
+    _worker_state['isolate_configs'] = isolate_configs
+    # Train gene prediction on the first assembly, if needed, so that all assemblies are annotated with one model
+    if config.prodigal_training_fp and not config.no_reannotation:
+        annotate.prepare_training(assembly_fps[0], config.prodigal_training_fp, config.gene_caller)
+    # Check and annotate assemblies, recording paths set in workers
+    exit_codes = [None] * len(isolate_configs)
+    runtimes = [0.0] * len(isolate_configs)
+    prepare_results = run_workers(prepare_isolate, range(len(isolate_configs)), config.workers)
+    for i, (exit_code, runtime, output_fps) in enumerate(prepare_results):
+        if output_fps is not None:
+            isolate_configs[i].assembly_genbank_fp, isolate_configs[i].model_output_fp = output_fps
+        runtimes[i] += runtime
+        if exit_code != 0:
+            exit_codes[i] = exit_code
+    # Align unique proteins across all isolates then create each draft model from its share of the hits. There is
+    # nothing to align should no isolate be prepared, but failures are still reported
+    isolate_indices = [i for i, exit_code in enumerate(exit_codes) if exit_code is None]
+    if not isolate_indices:
+        print('error: no assemblies could be prepared, skipping draft model creation', file=sys.stderr)
+    else:
+        _worker_state['allele_alignment'] = AlleleAlignment(
+            [isolate_configs[i].assembly_genbank_fp for i in isolate_indices],
+            config.model_ref_proteins_fp,
+            config.alignment_options,
+            dh.name,
+            aligner=config.aligner,
+            alignment_cache=config.alignment_cache,
+        )
+        _worker_state['alignment_indices'] = {i: j for j, i in enumerate(isolate_indices)}
+        draft_results = run_workers(draft_isolate, isolate_indices, config.workers)
+        for i, (exit_code, runtime, _) in zip(isolate_indices, draft_results):
+            exit_codes[i] = exit_code
+            runtimes[i] += runtime
+    _worker_state.clear()
+    # Explicitly remove temporary directory
+    dh.cleanup()
+    # Report outcome for each isolate, only exiting with an error if an isolate could not be processed
+    summary_fp = config.output_dir / 'batch_summary.tsv'
+    write_summary(isolate_configs, exit_codes, runtimes, summary_fp)
+    print('\n========================================')
+    print('batch draft model creation summary')
+    print('========================================')
+    for assembly_fp, exit_code in zip(assembly_fps, exit_codes):
+        print(assembly_fp, exit_code, sep='\t')
+    print(f'Wrote batch summary to {summary_fp}')
+    if any(exit_code not in {0, 101} for exit_code in exit_codes):
+        sys.exit(1)
+
+
+def collect_assemblies(config):
+    if config.assembly_list_fp:
+        assembly_fps = read_assembly_list(config.assembly_list_fp)
+        source = config.assembly_list_fp
+    else:
+        assembly_fps = sorted(pathlib.Path(fp) for fp in glob.glob(config.assembly_glob))
+        source = config.assembly_glob
+        if not assembly_fps:
+            print(f'error: no assemblies found matching {config.assembly_glob}', file=sys.stderr)
+            sys.exit(1)
+    # Outputs are named by assembly filename so these must be unique
+    stems = [assembly_fp.stem for assembly_fp in assembly_fps]
+    if len(set(stems)) != len(stems):
+        print(f'error: assembly filenames in {source} must be unique', file=sys.stderr)
+        sys.exit(1)
+    return assembly_fps
+
+
+def read_assembly_list(assembly_list_fp):
+    with assembly_list_fp.open('r') as fh:
+        assembly_fps = [pathlib.Path(line.strip()) for line in fh if line.strip()]
+    for assembly_fp in assembly_fps:
+        if not assembly_fp.exists():
+            print(f'error: input {assembly_fp} in {assembly_list_fp} does not exist', file=sys.stderr)
+            sys.exit(1)
+    return assembly_fps
+
+
+def run_workers(function, indices, workers):
+    # Each isolate is processed in its own forked process so that one that dies, such as when killed for exceeding
+    # available memory or aborted by a solver, is recorded as failed while remaining isolates are still processed
+    sys.stdout.flush()
+    sys.stderr.flush()
+    context = multiprocessing.get_context('fork')
+    results = dict()
+    running = dict()
+    indices_pending = list(indices)
+    try:
+        while indices_pending or running:
+            while indices_pending and len(running) < workers:
+                index = indices_pending.pop(0)
+                connection_recv, connection_send = context.Pipe(duplex=False)
+                process = context.Process(target=run_worker_send, args=(function, index, connection_send))
+                process.start()
+                connection_send.close()
+                running[index] = (process, connection_recv, time.perf_counter())
+            connections = [connection for process, connection, time_start in running.values()]
+            multiprocessing.connection.wait(connections)
+            for index, (process, connection, time_start) in list(running.items()):
+                if not connection.poll():
+                    continue
+                try:
+                    results[index] = connection.recv()
+                except EOFError:
+                    # Process stopped without returning a result, record by its exit code where it has one
+                    process.join()
+                    assembly_fp = _worker_state['isolate_configs'][index].assembly_fp
+                    print(f'error: processing {assembly_fp} stopped with exit code {process.exitcode}', file=sys.stderr)
+                    results[index] = (process.exitcode or 1, time.perf_counter() - time_start, None)
+                process.join()
+                connection.close()
+                del running[index]
+    finally:
+        for process, connection, time_start in running.values():
+            process.terminate()
+            process.join()
+            connection.close()
+    return [results[index] for index in indices]
+
+
+def run_worker_send(function, index, connection):
+    connection.send(function(index))
+    connection.close()
+
+
+def prepare_isolate(index):
+    isolate_config = _worker_state['isolate_configs'][index]
+    exit_code, runtime = run_isolate_stage(prepare_isolate_assembly, isolate_config)
+    return exit_code, runtime, (isolate_config.assembly_genbank_fp, isolate_config.model_output_fp)
+
+
+def prepare_isolate_assembly(isolate_config):
+    # Later stages run in other worker processes and read the annotated genbank from disk, so it must be written
+    # before the worker returns and the records are not kept
+    draft_model.prepare_assembly(isolate_config)
+    draft_model.finish_assembly_genbank(isolate_config)
+    isolate_config.assembly_records = None
+
+
+def draft_isolate(index):
+    isolate_config = _worker_state['isolate_configs'][index]
+    allele_alignment = _worker_state['allele_alignment']
+    isolate_config.blastp_results = allele_alignment.isolate_results(_worker_state['alignment_indices'][index])
+    exit_code, runtime = run_isolate_stage(draft_model.run, isolate_config)
+    isolate_config.blastp_results = None
+    return exit_code, runtime, None
+
+
+def run_isolate_stage(function, isolate_config):
+    # pylint: disable=broad-except
+    # An isolate that fails is recorded by its exit code so that remaining isolates are still processed
+    time_start = time.perf_counter()
+    try:
+        function(isolate_config)
+        exit_code = 0
+    except SystemExit as err:
+        exit_code = err.code
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return exit_code, time.perf_counter() - time_start
+
+
+def write_summary(isolate_configs, exit_codes, runtimes, output_fp):
+    statuses = {0: 'success', 101: 'no_biomass'}
+    with output_fp.open('w') as fh:
+        print('assembly', 'model', 'status', 'exit_code', 'seconds', sep='\t', file=fh)
+        for isolate_config, exit_code, runtime in zip(isolate_configs, exit_codes, runtimes):
+            # Threshold grid outputs are named by grid point so there is no single model to report
+            model_written = exit_code in statuses and not isolate_config.threshold_points
+            model_fp = isolate_config.model_output_fp if model_written else 'NA'
+            if model_written and 'json' not in isolate_config.output_formats:
+                model_fp = model_fp.with_suffix('.xml')
+            status = statuses.get(exit_code, 'error')
+            print(isolate_config.assembly_fp, model_fp, status, exit_code, f'{runtime:.1f}', sep='\t', file=fh)
+
+
+class AlleleAlignment:
+    # Proteins of all isolates are collapsed to unique sequences (alleles), which are aligned against the reference
+    # once in each direction. Hits are expanded back to the locus tags of an isolate when requested
+    def __init__(self, iso_fps, ref_proteins_fp, alignment_options, dirpath, *, aligner='blast', alignment_cache=None):
+        alleles_fp = pathlib.Path(dirpath, 'alleles.fasta')
+        alleles = dict()
+        residue_counts = list()
+        self.isolate_loci = list()
+        with alleles_fp.open('w') as fh_out:
+            for iso_fp in iso_fps:
+                iso_proteins_fp = pathlib.Path(dirpath, 'isolate_proteins.fasta')
+                util.write_genbank_coding(iso_fp, iso_proteins_fp, seq_type='prot')
+                loci = list()
+                residue_count = 0
+                with iso_proteins_fp.open('r') as fh_in:
+                    for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh_in):
+                        if seq not in alleles:
+                            alleles[seq] = len(alleles)
+                            print(f'>{alleles[seq]}', file=fh_out)
+                            print(*[seq[i : i + 80] for i in range(0, len(seq), 80)], sep='\n', file=fh_out)
+                        loci.append((desc, alleles[seq]))
+                        residue_count += len(seq)
+                self.isolate_loci.append(loci)
+                residue_counts.append(residue_count)
+        self.allele_count = len(alleles)
+        print(f'Collapsed {sum(len(loci) for loci in self.isolate_loci)} proteins to {self.allele_count} alleles')
+        # Run protein search bidirectionally without filtering. Searches against alleles report hits for every allele
+        # and use the mean isolate proteome size for evalues so that these are comparable to single isolate searches
+        search_options = {**alignment_options, 'threads': max(alignment_options['threads'] // 2, 1)}
+        search_options['prefilter'] = False
+        run_protein_search = alignment.ProteinAligners[aligner]
+        if alignment_cache:
+            run_protein_search = functools.partial(
+                alignment.run_alignment_cached, run_protein_search, cache_dir=alignment_cache
+            )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            iso_job = executor.submit(run_protein_search, alleles_fp, ref_proteins_fp, **search_options)
+            ref_job = executor.submit(
+                run_protein_search,
+                ref_proteins_fp,
+                alleles_fp,
+                max_target_seqs=max(self.allele_count, 1),
+                dbsize=int(np.mean(residue_counts)) if residue_counts else None,
+                **search_options,
+            )
+            self.iso_hits = iso_job.result()
+            self.ref_hits = ref_job.result()
+        self.ref_hit_alleles = self.ref_hits.hits.sseqid.astype(np.int64)
+
+    def isolate_results(self, index):
+        # Isolate to reference hits, expanding each allele's hits to the loci carrying it in isolate protein order
+        iso_parts = list()
+        iso_labels = list()
+        allele_loci = dict()
+        for locus, allele in self.isolate_loci[index]:
+            if allele not in allele_loci:
+                allele_loci[allele] = list()
+            allele_loci[allele].append(locus)
+            if (hits := self.iso_hits.get(str(allele))) is None:
+                continue
+            iso_parts.append(hits)
+            iso_labels.extend([locus] * len(hits))
+        iso_hits = np.concatenate(iso_parts) if iso_parts else self.iso_hits.hits[:0]
+        blastp_iso_all = alignment.relabel_hits(iso_hits, 'qseqid', iso_labels)
+        # Reference to isolate hits, retaining only hits to alleles present and duplicating for each locus
+        allele_counts = np.zeros(self.allele_count, dtype=np.int64)
+        for allele, loci in allele_loci.items():
+            allele_counts[allele] = len(loci)
+        hit_counts = allele_counts[self.ref_hit_alleles]
+        hit_indices = np.repeat(np.arange(len(hit_counts)), hit_counts)
+        ref_hit_alleles = self.ref_hit_alleles[hit_counts > 0].tolist()
+        ref_labels = [locus for allele in ref_hit_alleles for locus in allele_loci[allele]]
+        blastp_ref_all = alignment.relabel_hits(self.ref_hits.hits[hit_indices], 'sseqid', ref_labels)
+        return blastp_iso_all, blastp_ref_all
@@ -8,22 +8,65 @@ class ConfigDraftModel:
         self.ref_genbank_fp = args.ref_genbank_fp
         self.ref_genes_fp = args.ref_genes_fp
         self.ref_proteins_fp = args.ref_proteins_fp
+        self.ref_bundle = args.ref_bundle
         self.media_type = args.media_type
         self.atmosphere_type = args.atmosphere_type
         self.min_coverage = args.min_coverage
         self.min_pident = args.min_pident
         self.min_ppos = args.min_ppos
+        self.threshold_grid = args.threshold_grid
+        self.threshold_grid_models = args.threshold_grid_models
         self.biomass_reaction_id = args.biomass_reaction_id
         self.no_reannotation = args.no_reannotation
+        self.gene_caller = args.gene_caller
+        self.prodigal_training_fp = args.prodigal_training_fp
+        self.threads = args.threads
+        self.aligner = args.aligner
+        self.blast_split_query = args.blast_split_query
+        self.blast_db_cache = args.blast_db_cache
+        self.alignment_cache = args.alignment_cache
+        self.model_cache = args.model_cache
+        self.model_cache_size = args.model_cache_size
+        self.blast_prefilter = args.blast_prefilter
+        self.exact_match_orthologs = args.exact_match_orthologs
         self.memote_report_fp = args.memote_report_fp
         self.output_fp = args.output_fp
+        self.output_formats = args.output_formats
+        self.gapfill_timeout = args.gapfill_timeout
+        self.gapfill_universal = args.gapfill_universal
 
         self.alignment_thresholds = None
+        self.threshold_points = None
+        self.alignment_options = None
+        self.gapfill_options = None
         self.assembly_genbank_fp = None
+        self.assembly_records = None
+        self.assembly_genbank_job = None
         self.model = None
         self.model_genes_fp = None
         self.model_proteins_fp = None
         self.model_output_fp = None
+        self.blastp_results = None
+
+
+class ConfigDraftModelBatch(ConfigDraftModel):
+    def __init__(self, args):
+        super().__init__(args)
+        self.assembly_list_fp = args.assembly_list_fp
+        self.assembly_glob = args.assembly_glob
+        self.output_dir = args.output_dir
+        self.workers = args.workers
+
+
+class ConfigPrepareReference:
+    def __init__(self, args):
+
+        self.ref_model_fp = args.ref_model_fp
+        self.ref_genbank_fp = args.ref_genbank_fp
+        self.ref_genes_fp = args.ref_genes_fp
+        self.ref_proteins_fp = args.ref_proteins_fp
+        self.aligner = args.aligner
+        self.output_dir = args.output_dir
 
 
 class ConfigPatchModel:
@@ -36,7 +79,10 @@ class ConfigPatchModel:
         self.atmosphere_type = args.atmosphere_type
         self.biomass_reaction_id = args.biomass_reaction_id
         self.output_fp = args.output_fp
+        self.output_formats = args.output_formats
         self.memote_report_fp = args.memote_report_fp
+        self.model_cache = args.model_cache
+        self.model_cache_size = args.model_cache_size
 
 
 class ConfigFba:
@@ -47,6 +93,8 @@ class ConfigFba:
         self.fba_spec_fp = args.fba_spec_fp
         self.fba_spec_name = args.fba_spec_name
         self.output_fp = args.output_fp
+        self.model_cache = args.model_cache
+        self.model_cache_size = args.model_cache_size
 
 
 class ConfigSgk:
@@ -56,3 +104,5 @@ class ConfigSgk:
         self.media_type = args.media_type
         self.atmosphere_type = args.atmosphere_type
         self.output_fp = args.output_fp
+        self.model_cache = args.model_cache
+        self.model_cache_size = args.model_cache_size
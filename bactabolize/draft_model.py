@@ -1,54 +1,173 @@
-import contextlib
+import concurrent.futures
+import copy
+import functools
+import itertools
 import math
+import multiprocessing
+import multiprocessing.connection
 import pathlib
 import sys
 import tempfile
+import time
 import csv
 
-import Bio.Seq
 import Bio.SeqIO
+import cobra
+import cobra.core
+import cobra.core.gene
 import cobra.core.reaction
+import cobra.exceptions
 import cobra.flux_analysis
 import cobra.io
 import cobra.manipulation
 import cobra.manipulation.modify
+import cobra.util.solver
+import numpy as np
 
 
 from . import alignment
+from . import annotate
 from . import package_data
+from . import reference_bundle
 from . import util
 
 
+# BLASTn hits of reference genes without a protein ortholog must pass these to be considered unannotated orthologs
+BlastnThresholds = {'min_coverage': 80, 'min_pident': 80}
+# Integer thresholds for gapfilling attempts in order of preference, ranging from default 1e-6 to 0
+GapfillThresholds = [math.pow(10, y) for y in (-6, -7, -10, -20, -50, -math.inf)]
+# Minimum objective value of gapfilled models, the COBRApy default
+GapfillLowerBound = 0.05
+
+
+def prepare_assembly(config):
+    assembly_filetype = util.determine_assembly_filetype(config.assembly_fp)
+    # If we have a FASTA input, require that we annotate
+    if assembly_filetype == 'fasta' and config.no_reannotation:
+        print('error: cannot specify --no_reannotation with a FASTA input assembly', file=sys.stderr)
+        sys.exit(1)
+    # Run annotation if requested
+    if not config.no_reannotation:
+        config.assembly_genbank_fp = config.output_fp.parent / f'{config.output_fp.stem}.gbk'
+        if config.prodigal_training_fp:
+            annotate.prepare_training(config.assembly_fp, config.prodigal_training_fp, config.gene_caller)
+        # Annotated records are kept for draft model creation while the genbank is written in the background
+        config.assembly_records, config.assembly_genbank_job = annotate.run(
+            config.assembly_fp,
+            config.assembly_genbank_fp,
+            gene_caller=config.gene_caller,
+            threads=config.threads,
+            training_fp=config.prodigal_training_fp,
+        )
+    else:
+        config.assembly_genbank_fp = config.assembly_fp
+    config.model_output_fp = config.output_fp.parent / f'{config.output_fp.stem}_model.json'
+
+
+def finish_assembly_genbank(config):
+    # Wait for the annotated genbank to be written, raising any error encountered while writing
+    if config.assembly_genbank_job:
+        config.assembly_genbank_job.result()
+        config.assembly_genbank_job = None
+
+
+def prepare_reference(config, dirpath):
+    # A reference bundle holds the checked model, FASTAs and database so these are used directly
+    if config.ref_bundle:
+        reference_bundle.load(config)
+    else:
+        prepare_reference_inputs(config, dirpath)
+    if config.alignment_cache:
+        config.alignment_cache.mkdir(parents=True, exist_ok=True)
+    config.alignment_thresholds = {
+        'min_coverage': config.min_coverage,
+        'min_pident': config.min_pident,
+        'min_ppos': config.min_ppos,
+    }
+    config.threshold_points = create_threshold_points(config.alignment_thresholds, config.threshold_grid)
+    config.alignment_options = {
+        'threads': config.threads,
+        'split_query': config.blast_split_query,
+        'prefilter': config.blast_prefilter,
+    }
+    config.gapfill_options = {
+        'universal': config.gapfill_universal,
+        'processes': config.threads,
+        'timeout': config.gapfill_timeout,
+    }
+
+
+def prepare_reference_inputs(config, dirpath):
+    # If model is provided as a genbank, convert to FASTA
+    if config.ref_genbank_fp:
+        config.model_ref_genes_fp = pathlib.Path(dirpath, 'ref_genes.fasta')
+        config.model_ref_proteins_fp = pathlib.Path(dirpath, 'ref_proteins.fasta')
+        util.extract_genbank_coding(
+            config.ref_genbank_fp, genes_fp=config.model_ref_genes_fp, proteins_fp=config.model_ref_proteins_fp
+        )
+    else:
+        config.model_ref_genes_fp = config.ref_genes_fp
+        config.model_ref_proteins_fp = config.ref_proteins_fp
+    # Reuse reference protein database from cache if requested, creating it if needed. Reference genes are only
+    # ever used as BLAST queries so do not require a database
+    if config.blast_db_cache:
+        config.blast_db_cache.mkdir(parents=True, exist_ok=True)
+        config.model_ref_proteins_fp = alignment.cache_blast_database(
+            config.model_ref_proteins_fp, 'prot', config.blast_db_cache
+        )
+    config.model = util.read_model_and_check(
+        config.ref_model_fp,
+        config.model_ref_genes_fp,
+        config.model_ref_proteins_fp,
+        cache_dir=config.model_cache,
+        cache_size=config.model_cache_size,
+    )
+
+
+def create_threshold_points(alignment_thresholds, threshold_grid):
+    # Each point takes one value from every grid threshold, with the remaining thresholds unchanged
+    if not threshold_grid:
+        return None
+    threshold_names = [name for name, values in threshold_grid]
+    threshold_points = list()
+    for values in itertools.product(*(values for name, values in threshold_grid)):
+        threshold_points.append({**alignment_thresholds, **dict(zip(threshold_names, values))})
+    return threshold_points
+
+
 def run(config):
     print('\n========================================')
     print('running draft model creation of ' + config.assembly_genbank_fp.stem)
     print('========================================')
     # Get orthologs of genes in model
     model_genes = {gene.id for gene in config.model.genes}
+    if config.threshold_points:
+        run_threshold_grid(config, model_genes)
+        return
     isolate_orthologs, blast_results, unannotated_sequences = identify(
         config.assembly_genbank_fp,
         config.model_ref_genes_fp,
         config.model_ref_proteins_fp,
         model_genes,
         config.alignment_thresholds,
+        config.alignment_options,
+        aligner=config.aligner,
+        alignment_cache=config.alignment_cache,
+        exact_match=config.exact_match_orthologs,
+        blastp_results=config.blastp_results,
+        iso_records=config.assembly_records,
     )
+    write_draft_model(config, model_genes, isolate_orthologs, blast_results, unannotated_sequences)
 
+
+def write_draft_model(config, model_genes, isolate_orthologs, blast_results, unannotated_sequences):
     # Writing all identified unannotated sequences to a fasta file (can't be matched to genbank)
     fasta_output = config.output_fp.parent / f'{config.output_fp.stem}_unannotated_sequences.fasta'
     with open(fasta_output, "w") as output_handle:
         Bio.SeqIO.write(unannotated_sequences, output_handle, "fasta")
 
     # Remove genes from model that have no ortholog in the isolate
-    missing_genes = list()
-    for gene in model_genes - set(isolate_orthologs):
-        # NOTE: must handle artificial genes better
-        if gene == 'KPN_SPONT':
-            continue
-        missing_genes.append(config.model.genes.get_by_id(gene))
-    # Mutate a copy of the model and rename genes
-    model_draft = config.model.copy()
-    model_draft.id = config.assembly_genbank_fp.stem
-    cobra.manipulation.remove_genes(model_draft, missing_genes, remove_reactions=True)
+    model_draft = create_draft_model(config.model, model_genes, isolate_orthologs, config.assembly_genbank_fp.stem)
 
     # Save original gene IDs prior to replacing with genome annotations
     original_genes = []
@@ -66,23 +185,216 @@ def run(config):
     # Mutate a copy of the model and rename genes
     cobra.manipulation.modify.rename_genes(model_draft, isolate_orthologs)
 
-    # Write model to disk and assess model
-    with config.model_output_fp.open('w') as fh:
-        cobra.io.save_json_model(model_draft, fh)
-        cobra.io.write_sbml_model(model_draft, str(config.model_output_fp).rsplit('.', 1)[0] + '.xml')  # .xml output
-    assess_model(
-        config.model,
-        model_draft,
-        blast_results,
-        config.media_type,
-        config.atmosphere_type,
-        config.biomass_reaction_id,
-        config.model_output_fp,
+    # Write model to disk while assessing model. The annotated genbank is written first as no other threads may be
+    # running when the model writer is forked
+    finish_assembly_genbank(config)
+    model_write = util.write_model_background(model_draft, config.model_output_fp, config.output_formats)
+    try:
+        assess_model(
+            config.model,
+            model_draft,
+            blast_results,
+            config.media_type,
+            config.atmosphere_type,
+            config.biomass_reaction_id,
+            config.model_output_fp,
+            config.gapfill_options,
+        )
+
+        # Generate MEMOTE report file if requested
+        if config.memote_report_fp:
+            util.generate_memote_report(model_draft, config.memote_report_fp)
+    finally:
+        util.finish_model_write(model_write)
+
+
+def create_draft_model(model, model_genes, isolate_orthologs, model_id):
+    # Remove genes from model that have no ortholog in the isolate
+    missing_genes = list()
+    for gene in model_genes - set(isolate_orthologs):
+        # NOTE: must handle artificial genes better
+        if gene == 'KPN_SPONT':
+            continue
+        missing_genes.append(model.genes.get_by_id(gene))
+    # Build the draft from only the retained parts of the reference rather than copying then removing from it. The
+    # reference is not modified so that it remains shared between batch workers
+    missing_gene_ids = {gene.id for gene in missing_genes}
+    reactions_removed = find_removed_reactions(missing_genes, missing_gene_ids)
+    model_draft = create_model_shell(model, model_id)
+    # Reactions are linked to metabolites before these are added to the draft, cobra otherwise copies each metabolite
+    metabolites_draft = cobra.DictList(copy_metabolite(metabolite) for metabolite in model.metabolites)
+    reactions_draft = list()
+    for reaction in model.reactions:
+        if reaction in reactions_removed:
+            continue
+        reactions_draft.append(copy_reaction(reaction, metabolites_draft))
+    model_draft.add_metabolites(metabolites_draft)
+    # Genes are added prior to reactions to retain reference order and those without reactions
+    for gene in model.genes:
+        if gene.id in missing_gene_ids:
+            continue
+        gene_draft = copy_gene(gene)
+        gene_draft._model = model_draft  # pylint: disable=protected-access
+        model_draft.genes.append(gene_draft)
+    model_draft.add_reactions(reactions_draft)
+    model_draft.objective = {
+        model_draft.reactions.get_by_id(reaction.id): coefficient
+        for reaction, coefficient in cobra.util.solver.linear_reaction_coefficients(model).items()
+        if reaction not in reactions_removed
+    }
+    model_draft.objective_direction = model.objective_direction
+    model_draft.add_groups(copy_groups(model.groups, model_draft))
+    # Simplify rules of retained reactions, which also removes missing genes these still refer to
+    missing_genes_draft = [gene_id for gene_id in missing_gene_ids if model_draft.genes.has_id(gene_id)]
+    cobra.manipulation.remove_genes(model_draft, missing_genes_draft, remove_reactions=True)
+    return model_draft
+
+
+def find_removed_reactions(missing_genes, missing_gene_ids):
+    # Only reactions of missing genes can be lost, these are those with a rule that fails without missing genes
+    reactions_checked = set()
+    reactions_removed = set()
+    for gene in missing_genes:
+        for reaction in gene.reactions:
+            if reaction in reactions_checked:
+                continue
+            reactions_checked.add(reaction)
+            rule_tree, _ = cobra.core.gene.parse_gpr(reaction.gene_reaction_rule)
+            if not cobra.core.gene.eval_gpr(rule_tree, missing_gene_ids):
+                reactions_removed.add(reaction)
+    return reactions_removed
+
+
+def create_model_shell(model, model_id):
+    model_draft = cobra.Model(model_id, name=model.name)
+    model_draft.notes = copy.deepcopy(model.notes)
+    model_draft.annotation = copy.deepcopy(model.annotation)
+    model_draft.compartments = model.compartments
+    model_draft.tolerance = model.tolerance
+    # Retain metadata of SBML models, such as units, as is done by cobra.Model.copy
+    if hasattr(model, '_sbml'):
+        model_draft._sbml = model._sbml  # pylint: disable=protected-access
+    return model_draft
+
+
+def copy_metabolite(metabolite):
+    metabolite_draft = cobra.Metabolite(
+        metabolite.id,
+        formula=metabolite.formula,
+        name=metabolite.name,
+        charge=metabolite.charge,
+        compartment=metabolite.compartment,
+    )
+    metabolite_draft.notes = copy.copy(metabolite.notes)
+    metabolite_draft.annotation = copy.copy(metabolite.annotation)
+    return metabolite_draft
+
+
+def copy_gene(gene):
+    gene_draft = cobra.Gene(gene.id, name=gene.name, functional=gene.functional)
+    gene_draft.notes = copy.copy(gene.notes)
+    gene_draft.annotation = copy.copy(gene.annotation)
+    return gene_draft
+
+
+def copy_reaction(reaction, metabolites_draft):
+    reaction_draft = cobra.Reaction(
+        reaction.id,
+        name=reaction.name,
+        subsystem=reaction.subsystem,
+        lower_bound=reaction.lower_bound,
+        upper_bound=reaction.upper_bound,
+    )
+    reaction_draft.notes = copy.copy(reaction.notes)
+    reaction_draft.annotation = copy.copy(reaction.annotation)
+    reaction_draft.add_metabolites(
+        {
+            metabolites_draft.get_by_id(metabolite.id): coefficient
+            for metabolite, coefficient in reaction.metabolites.items()
+        }
     )
+    reaction_draft.gene_reaction_rule = reaction.gene_reaction_rule
+    return reaction_draft
+
+
+def copy_groups(groups, model_draft):
+    # Members removed from the draft are dropped, groups themselves are all retained
+    groups_draft = [cobra.core.Group(group.id, name=group.name, kind=group.kind) for group in groups]
+    model_objects = {
+        cobra.Metabolite: model_draft.metabolites,
+        cobra.Reaction: model_draft.reactions,
+        cobra.Gene: model_draft.genes,
+        cobra.core.Group: cobra.DictList(groups_draft),
+    }
+    for group, group_draft in zip(groups, groups_draft):
+        members = list()
+        for member in group.members:
+            for member_type, model_members in model_objects.items():
+                if isinstance(member, member_type) and model_members.has_id(member.id):
+                    members.append(model_members.get_by_id(member.id))
+        group_draft.notes = copy.copy(group.notes)
+        group_draft.annotation = copy.copy(group.annotation)
+        group_draft.add_members(members)
+    return groups_draft
 
-    # Generate MEMOTE report file if requested
-    if config.memote_report_fp:
-        util.generate_memote_report(model_draft, config.memote_report_fp)
+
+def run_threshold_grid(config, model_genes):
+    # Identify orthologs at each point of the threshold grid from a single alignment
+    point_results = identify_grid(
+        config.assembly_genbank_fp,
+        config.model_ref_genes_fp,
+        config.model_ref_proteins_fp,
+        model_genes,
+        config.threshold_points,
+        config.alignment_options,
+        aligner=config.aligner,
+        alignment_cache=config.alignment_cache,
+        exact_match=config.exact_match_orthologs,
+        blastp_results=config.blastp_results,
+        iso_records=config.assembly_records,
+    )
+    # Summarise the draft model of each point, only writing full outputs for selected points. Protein orthologs and
+    # those of unannotated sequences are counted separately
+    grid_fp = config.output_fp.parent / f'{config.output_fp.stem}_threshold_grid.tsv'
+    header = ('point', *config.alignment_thresholds, 'orthologs', 'unannotated', 'genes', 'reactions', 'biomass')
+    failed_points = list()
+    with grid_fp.open('w') as fh:
+        print(*header, sep='\t', file=fh)
+        for point, (alignment_thresholds, results) in enumerate(zip(config.threshold_points, point_results), 1):
+            isolate_orthologs, blast_results, unannotated_sequences = results
+            model_draft = create_draft_model(
+                config.model, model_genes, isolate_orthologs, config.assembly_genbank_fp.stem
+            )
+            set_media(model_draft, config.media_type, config.atmosphere_type)
+            row = (
+                point,
+                *('NA' if value is None else value for value in alignment_thresholds.values()),
+                len(isolate_orthologs) - len(unannotated_sequences),
+                len(unannotated_sequences),
+                len(model_draft.genes),
+                len(model_draft.reactions),
+                f'{model_draft.slim_optimize(error_value=0):.6f}',
+            )
+            print(*row, sep='\t', file=fh)
+            if point not in config.threshold_grid_models:
+                continue
+            print(f'\nWriting draft model for threshold grid point {point}')
+            point_config = copy.copy(config)
+            point_config.output_fp = config.output_fp.parent / f'{config.output_fp.stem}_grid{point}.json'
+            point_config.model_output_fp = config.output_fp.parent / f'{config.output_fp.stem}_grid{point}_model.json'
+            if config.memote_report_fp:
+                memote_report_fp = config.memote_report_fp
+                point_config.memote_report_fp = memote_report_fp.parent / f'{memote_report_fp.stem}_grid{point}.html'
+            try:
+                write_draft_model(point_config, model_genes, isolate_orthologs, blast_results, unannotated_sequences)
+            except SystemExit as err:
+                if err.code != 101:
+                    raise
+                failed_points.append(point)
+    print(f'\nWrote threshold grid summary to {grid_fp}')
+    if failed_points:
+        print(f'error: draft models of grid points {", ".join(map(str, failed_points))} failed', file=sys.stderr)
+        sys.exit(101)
 
 
 def assess_model(
@@ -93,30 +405,10 @@ def assess_model(
     atmosphere_type,
     biomass_reaction_id,
     output_fp,
+    gapfill_options,
 ):
-    # pylint: disable=too-many-branches
     # Assess model by observing whether the objective function for biomass optimises
-    # We perform an set media
-    for reaction in model_draft.exchanges:
-        reaction.lower_bound = 0
-    media = package_data.get_data('media_definitions', media_type)
-    for reaction_id, lower_bound in media['exchanges'].items():
-        try:
-            reaction = model_draft.reactions.get_by_id(reaction_id)
-        except KeyError:
-            msg = f'warning: draft model does not contain reaction {reaction_id}'
-            print(msg, file=sys.stderr)
-        reaction.lower_bound = lower_bound
-
-    # Set atmospheric conditions
-    reaction_oxygen = model_draft.reactions.get_by_id('EX_o2_e')
-    if atmosphere_type == 'aerobic':
-        reaction_oxygen.lower_bound = -20
-    elif atmosphere_type == 'anaerobic':
-        reaction_oxygen.lower_bound = 0
-    elif atmosphere_type is not None:
-        raise ValueError
-
+    set_media(model_draft, media_type, atmosphere_type)
     solution = model_draft.optimize()
 
     # Threshold for whether a model produces biomass
@@ -129,7 +421,9 @@ def assess_model(
         )
 
         print(msg, file=sys.stderr)
-        create_troubleshooter(model, model_draft, blast_results, biomass_reaction_id, f'{output_fp}.troubleshoot')
+        create_troubleshooter(
+            model, model_draft, blast_results, biomass_reaction_id, f'{output_fp}.troubleshoot', gapfill_options
+        )
         sys.exit(101)
     else:
         print(f'{model_draft} model produces biomass on minimal media')
@@ -145,9 +439,34 @@ def assess_model(
         print(msg)
 
 
-def create_troubleshooter(model, model_draft, blast_results, biomass_reaction_id, prefix):
+def set_media(model_draft, media_type, atmosphere_type):
+    # We perform an set media
+    for reaction in model_draft.exchanges:
+        reaction.lower_bound = 0
+    media = package_data.get_data('media_definitions', media_type)
+    for reaction_id, lower_bound in media['exchanges'].items():
+        try:
+            reaction = model_draft.reactions.get_by_id(reaction_id)
+        except KeyError:
+            msg = f'warning: draft model does not contain reaction {reaction_id}'
+            print(msg, file=sys.stderr)
+        reaction.lower_bound = lower_bound
+
+    # Set atmospheric conditions
+    reaction_oxygen = model_draft.reactions.get_by_id('EX_o2_e')
+    if atmosphere_type == 'aerobic':
+        reaction_oxygen.lower_bound = -20
+    elif atmosphere_type == 'anaerobic':
+        reaction_oxygen.lower_bound = 0
+    elif atmosphere_type is not None:
+        raise ValueError
+
+
+def create_troubleshooter(model, model_draft, blast_results, biomass_reaction_id, prefix, gapfill_options):
     # Determine what required products model cannot product and missing reactions/genes
-    reactions_missing, gapfilled, nonzero_threshold = gapfill_model(model, model_draft)
+    reactions_missing, gapfilled, nonzero_threshold = gapfill_model(
+        model, model_draft, blast_results, **gapfill_options
+    )
     metabolites_missing = check_biomass_metabolites(model_draft.copy(), biomass_reaction_id)
     # Collect BLAST results
     blastp_hits = dict()
@@ -204,24 +523,28 @@ def check_biomass_metabolites(model, biomass_reaction_id):
     return metabolites_missing
 
 
-def gapfill_model(model, model_draft):
-    # pylint: disable=undefined-loop-variable
-    # Attempt gapfilling with thresholds ranging from default 1e-6 to 0
-    integer_thresholds = [math.pow(10, y) for y in (-6, -7, -10, -20, -50, -math.inf)]
-    for threshold in integer_thresholds:
-        gapfiller = cobra.flux_analysis.gapfilling.GapFiller(
-            model=model_draft,
-            universal=model,
-            demand_reactions=False,
-            integer_threshold=threshold,
-        )
-        try:
-            gapfilled = gapfiller.fill(
-                iterations=5,
+def gapfill_model(model, model_draft, blast_results, *, universal='full', processes=1, timeout=None):
+    # Gapfill from reference reactions with alignment evidence if requested, otherwise or should that fail from all
+    # reference reactions
+    threshold, gapfilled_ids = None, None
+    if universal == 'evidence':
+        model_universal = create_evidence_universal(model, model_draft, blast_results)
+        print(f'Gapfilling from {len(model_universal.reactions)} reference reactions with alignment evidence')
+        # Check once that gapfilling can succeed rather than failing at each threshold. A threshold of 0 is rejected
+        # by some solvers so is not attempted, and solver errors are considered failed attempts, in order to fall back
+        if check_gapfill_feasible(model_universal, model_draft):
+            thresholds = [threshold for threshold in GapfillThresholds if threshold > 0]
+            threshold, gapfilled_ids = gapfill_model_thresholds(
+                model_universal, model_draft, processes, timeout, thresholds=thresholds, errors_fatal=False
             )
-            break
-        except RuntimeError:
-            continue
+        if gapfilled_ids is None:
+            print('Gapfilling from reactions with alignment evidence failed, using all reference reactions')
+    if gapfilled_ids is None:
+        threshold, gapfilled_ids = gapfill_model_thresholds(model, model_draft, processes, timeout)
+    if gapfilled_ids is None:
+        print('error: gapfilling failed at all integer thresholds', file=sys.stderr)
+        sys.exit(1)
+    gapfilled = [[model.reactions.get_by_id(reaction_id) for reaction_id in result] for result in gapfilled_ids]
 
     # Gather missing reactions
     reactions_missing = dict()
@@ -233,6 +556,159 @@ def gapfill_model(model, model_draft):
     return reactions_missing, gapfilled, threshold
 
 
+def create_evidence_universal(model, model_draft, blast_results):
+    # Reference reactions absent from the draft without genes or with a gene having any hit, regardless of thresholds,
+    # or an exact sequence match
+    genes_evidence = set(blast_results['blastp_ref']) | set(blast_results['blastn']) | set(blast_results['exact'])
+    for hits in blast_results['blastp_iso'].values():
+        genes_evidence.update(hits.sseqid.tolist())
+    reactions = list()
+    metabolites_universal = cobra.DictList()
+    for reaction in model.reactions:
+        if model_draft.reactions.has_id(reaction.id):
+            continue
+        if reaction.genes and not any(gene.id in genes_evidence for gene in reaction.genes):
+            continue
+        reactions.append(reaction)
+        for metabolite in reaction.metabolites:
+            if not metabolites_universal.has_id(metabolite.id):
+                metabolites_universal.append(copy_metabolite(metabolite))
+    reactions_universal = [copy_reaction(reaction, metabolites_universal) for reaction in reactions]
+    model_universal = cobra.Model('universal')
+    model_universal.add_metabolites(metabolites_universal)
+    model_universal.add_reactions(reactions_universal)
+    return model_universal
+
+
+def check_gapfill_feasible(model, model_draft):
+    # Gapfilling can only succeed if the draft reaches the minimum objective value with all universal reactions
+    with model_draft:
+        model_draft.add_reactions([reaction.copy() for reaction in model.reactions])
+        return model_draft.slim_optimize(error_value=0) >= GapfillLowerBound
+
+
+def gapfill_model_thresholds(model, model_draft, processes, timeout, *, thresholds=None, errors_fatal=True):
+    # Attempt gapfilling with thresholds ranging from default 1e-6 to 0, using the first in this order to succeed.
+    # Attempts are run concurrently in forked processes when requested or required to apply a timeout
+    if thresholds is None:
+        thresholds = GapfillThresholds
+    if (processes == 1 and timeout is None) or multiprocessing.current_process().daemon:
+        if timeout is not None:
+            print('warning: cannot apply gapfilling timeout in a daemonic process', file=sys.stderr)
+        return gapfill_model_sequential(model, model_draft, thresholds, errors_fatal)
+    return gapfill_model_parallel(model, model_draft, thresholds, processes, timeout, errors_fatal)
+
+
+def gapfill_model_sequential(model, model_draft, thresholds, errors_fatal):
+    for threshold in thresholds:
+        try:
+            gapfilled_ids = gapfill_model_threshold(model, model_draft, threshold)
+        except Exception as err:  # pylint: disable=broad-except
+            if errors_fatal:
+                raise
+            print(f'Gapfilling with threshold {threshold} failed unexpectedly: {err}')
+            gapfilled_ids = None
+        if gapfilled_ids is not None:
+            return threshold, gapfilled_ids
+    return None, None
+
+
+def gapfill_model_parallel(model, model_draft, thresholds, processes, timeout, errors_fatal):
+    # pylint: disable=too-many-branches
+    # Attempts are started in threshold order. Once an attempt succeeds, those after it are no longer needed and
+    # are cancelled. Attempts exceeding the timeout are cancelled and considered failed
+    sys.stdout.flush()
+    sys.stderr.flush()
+    context = multiprocessing.get_context('fork')
+    results = dict()
+    running = dict()
+    indices_pending = list(range(len(thresholds)))
+    indices_error = set()
+    try:
+        while True:
+            # Use the first successful attempt once all attempts prior have failed. As when run sequentially, an
+            # unexpected error is only raised once all attempts prior have failed
+            for index in range(len(thresholds)):
+                if index not in results:
+                    break
+                if index in indices_error and errors_fatal:
+                    print('error: gapfilling failed unexpectedly', file=sys.stderr)
+                    sys.exit(1)
+                if results[index] is not None:
+                    return thresholds[index], results[index]
+            else:
+                return None, None
+            index_success = min((i for i, result in results.items() if result is not None), default=None)
+            for i, (process, connection, time_start) in list(running.items()):
+                if index_success is not None and i > index_success:
+                    stop_gapfill_process(process, connection)
+                    del running[i]
+            while indices_pending and len(running) < processes:
+                i = indices_pending.pop(0)
+                if index_success is not None and i > index_success:
+                    continue
+                connection_recv, connection_send = context.Pipe(duplex=False)
+                args = (model, model_draft, thresholds[i], connection_send)
+                process = context.Process(target=gapfill_model_threshold_send, args=args)
+                process.start()
+                connection_send.close()
+                running[i] = (process, connection_recv, time.monotonic())
+            # Wait for an attempt to finish or time out
+            wait_timeout = None
+            if timeout is not None:
+                time_first = min(time_start for process, connection, time_start in running.values())
+                wait_timeout = max(time_first + timeout - time.monotonic(), 0)
+            connections = [connection for process, connection, time_start in running.values()]
+            multiprocessing.connection.wait(connections, timeout=wait_timeout)
+            for i, (process, connection, time_start) in list(running.items()):
+                if connection.poll():
+                    try:
+                        results[i] = connection.recv()
+                    except EOFError:
+                        # Attempt stopped by an error, which has been reported by the process
+                        results[i] = None
+                        indices_error.add(i)
+                elif timeout is not None and time.monotonic() - time_start >= timeout:
+                    print(f'Gapfilling with threshold {thresholds[i]} exceeded {timeout} seconds')
+                    results[i] = None
+                else:
+                    continue
+                stop_gapfill_process(process, connection)
+                del running[i]
+    finally:
+        for process, connection, time_start in running.values():
+            stop_gapfill_process(process, connection)
+
+
+def stop_gapfill_process(process, connection):
+    process.terminate()
+    process.join()
+    connection.close()
+
+
+def gapfill_model_threshold_send(model, model_draft, threshold, connection):
+    connection.send(gapfill_model_threshold(model, model_draft, threshold))
+    connection.close()
+
+
+def gapfill_model_threshold(model, model_draft, threshold):
+    # Reactions are returned by identifier so that results can be sent from other processes
+    gapfiller = cobra.flux_analysis.gapfilling.GapFiller(
+        model=model_draft,
+        universal=model,
+        lower_bound=GapfillLowerBound,
+        demand_reactions=False,
+        integer_threshold=threshold,
+    )
+    try:
+        gapfilled = gapfiller.fill(
+            iterations=5,
+        )
+    except (RuntimeError, cobra.exceptions.Infeasible):
+        return None
+    return [[reaction.id for reaction in result] for result in gapfilled]
+
+
 def write_troubleshoot_summary(
     model,
     metabolites_missing,
@@ -308,80 +784,318 @@ def write_blast_results(data, output_fp):
     with output_fp.open('w') as fh:
         print(*alignment.BlastFormat, sep='\t', file=fh)
         for hits in data.values():
-            print(*hits, sep='\n', file=fh)
+            print(*(alignment.format_hit(hit) for hit in hits), sep='\n', file=fh)
 
 
-def identify(iso_fp, ref_genes_fp, ref_proteins_fp, model_genes, alignment_thresholds):
+def identify(
+    iso_fp,
+    ref_genes_fp,
+    ref_proteins_fp,
+    model_genes,
+    alignment_thresholds,
+    alignment_options,
+    *,
+    aligner='blast',
+    alignment_cache=None,
+    exact_match=False,
+    blastp_results=None,
+    iso_records=None,
+):
     # pylint: disable=consider-using-with
+    # Cached alignments are unfiltered so are evaluated in the same way as a threshold grid with a single point
+    if alignment_cache:
+        [results] = identify_grid(
+            iso_fp,
+            ref_genes_fp,
+            ref_proteins_fp,
+            model_genes,
+            [alignment_thresholds],
+            alignment_options,
+            aligner=aligner,
+            alignment_cache=alignment_cache,
+            exact_match=exact_match,
+            blastp_results=blastp_results,
+            iso_records=iso_records,
+        )
+        return results
     # First we perform a standard best bi-directional hit analysis to identify orthologs
     # Extract protein sequences from both genomes but only keep model genes from the reference
     dh = tempfile.TemporaryDirectory()
     iso_proteins_fp = pathlib.Path(dh.name, 'isolate_proteins.fasta')
-    util.write_genbank_coding(iso_fp, iso_proteins_fp, seq_type='prot')
-    # Run BLASTp bidirectionally (filtering with evalue <=1e-3, and user defined coverage, pident, ppos)
-    blastp_iso_all = alignment.run_blastp(iso_proteins_fp, ref_proteins_fp)
-    blastp_ref_all = alignment.run_blastp(ref_proteins_fp, iso_proteins_fp)
-    blastp_iso = alignment.filter_results(blastp_iso_all, **alignment_thresholds)
-    blastp_ref = alignment.filter_results(blastp_ref_all, **alignment_thresholds)
-
-    # Find orthologs from BLASTp results
+    iso_fasta_fp = pathlib.Path(dh.name, 'isolate_genes.fasta')
+    iso_sequences = util.extract_genbank_coding(
+        iso_fp, genes_fp=iso_fasta_fp, proteins_fp=iso_proteins_fp, records=iso_records
+    )
+    identical_orthologs, iso_query_fp, ref_query_fp = prepare_protein_queries(
+        iso_proteins_fp, ref_proteins_fp, dh.name, exact_match
+    )
+    # Run protein search bidirectionally (filtering with evalue <=1e-3, and user defined coverage, pident, ppos)
+    # unless unfiltered results have already been provided e.g. by batch alignment
+    if blastp_results:
+        blastp_iso_all, blastp_ref_all = exclude_identical_queries(blastp_results, identical_orthologs)
+        blastp_iso = alignment.filter_results(blastp_iso_all, **alignment_thresholds)
+        blastp_ref = alignment.filter_results(blastp_ref_all, **alignment_thresholds)
+        alignment.create_blast_database(iso_fasta_fp, 'nucl')
+    else:
+        blastp_iso, blastp_ref, blastp_iso_all, blastp_ref_all = run_blastp_bidirectional(
+            iso_fasta_fp,
+            iso_proteins_fp,
+            iso_query_fp,
+            ref_proteins_fp,
+            ref_query_fp,
+            alignment_thresholds,
+            alignment_options,
+            aligner,
+        )
+
+    # Find orthologs from BLASTp results, combining with those of identical sequence in reference order
     model_orthologs = discover_orthologs(blastp_ref, blastp_iso)
+    if identical_orthologs:
+        model_orthologs = merge_orthologs(ref_proteins_fp, identical_orthologs, model_orthologs)
 
     # For reference genes without orthologs, we check for unannotated hits
-    # Write isolate sequence as fasta
     model_genes_no_orth = model_genes.difference(set(model_orthologs))
-    iso_fasta_fp = pathlib.Path(dh.name, 'isolate_genes.fasta')
-    util.write_genbank_coding(iso_fp, iso_fasta_fp, seq_type='nucl')
     # Write reference gene sequences with no ortholog as fasta
     ref_genes_noorth_fp = pathlib.Path(dh.name, 'ref_genes_noorth.fasta')
-    with contextlib.ExitStack() as stack:
-        fin = stack.enter_context(ref_genes_fp.open('r'))
-        fout = stack.enter_context(ref_genes_noorth_fp.open('w'))
-        for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fin):
-            if desc not in model_genes_no_orth:
-                continue
-            print(f'>{desc}', file=fout)
-            print(*[seq[i : i + 80] for i in range(0, len(seq), 80)], sep='\n', file=fout)
+    util.write_fasta_subset(ref_genes_fp, ref_genes_noorth_fp, model_genes_no_orth)
     # Run BLASTn (filtering with evalue <=1e-3, coverage >=80%, and pident >=80%)
-    blastn_res_all = alignment.run_blastn(ref_genes_noorth_fp, iso_fasta_fp)
-    if len(blastn_res_all) != 0:
-        blastn_res = alignment.filter_results(blastn_res_all, min_coverage=80, min_pident=80)
-    else:
-        blastn_res = {}
+    blastn_res_all = alignment.SpilledResults()
+    blastn_res = alignment.run_blastn(
+        ref_genes_noorth_fp,
+        iso_fasta_fp,
+        thresholds=BlastnThresholds,
+        spill=blastn_res_all,
+        **alignment_options,
+    )
     # Discover unannotated model genes in isolate
-    model_orthologs, unannotated_sequences = discover_unannotated_orthologs(blastn_res, iso_fasta_fp, model_orthologs)
+    model_orthologs, unannotated_sequences = discover_unannotated_orthologs(blastn_res, iso_sequences, model_orthologs)
 
     # Return orthologs and BLAST results, explicitly remove temp directory
     dh.cleanup()
-    blast_results = {'blastp_iso': blastp_iso_all, 'blastp_ref': blastp_ref_all, 'blastn': blastn_res_all}
+    blast_results = {
+        'blastp_iso': blastp_iso_all,
+        'blastp_ref': blastp_ref_all,
+        'blastn': blastn_res_all,
+        'exact': identical_orthologs,
+    }
     return model_orthologs, blast_results, unannotated_sequences
 
 
-def discover_orthologs(blastp_ref, blastp_iso):
+def identify_grid(
+    iso_fp,
+    ref_genes_fp,
+    ref_proteins_fp,
+    model_genes,
+    threshold_points,
+    alignment_options,
+    *,
+    aligner='blast',
+    alignment_cache=None,
+    exact_match=False,
+    blastp_results=None,
+    iso_records=None,
+):
+    # pylint: disable=consider-using-with
+    # Align once without filtering then identify orthologs for each set of alignment thresholds
+    dh = tempfile.TemporaryDirectory()
+    iso_proteins_fp = pathlib.Path(dh.name, 'isolate_proteins.fasta')
+    iso_fasta_fp = pathlib.Path(dh.name, 'isolate_genes.fasta')
+    iso_sequences = util.extract_genbank_coding(
+        iso_fp, genes_fp=iso_fasta_fp, proteins_fp=iso_proteins_fp, records=iso_records
+    )
+    identical_orthologs, iso_query_fp, ref_query_fp = prepare_protein_queries(
+        iso_proteins_fp, ref_proteins_fp, dh.name, exact_match
+    )
+    if blastp_results:
+        blastp_iso_all, blastp_ref_all = exclude_identical_queries(blastp_results, identical_orthologs)
+        alignment.create_blast_database(iso_fasta_fp, 'nucl')
+    else:
+        blastp_iso_all, blastp_ref_all = run_blastp_bidirectional_unfiltered(
+            iso_fasta_fp,
+            iso_proteins_fp,
+            iso_query_fp,
+            ref_proteins_fp,
+            ref_query_fp,
+            alignment_options,
+            aligner,
+            alignment_cache,
+        )
+    # Search with all model genes so that BLASTn hits are independent of the orthologs found, and so of alignment
+    # thresholds. Hits of each query are unaffected by other queries, so subsetting is exact
+    ref_genes_model_fp = pathlib.Path(dh.name, 'ref_genes_model.fasta')
+    util.write_fasta_subset(ref_genes_fp, ref_genes_model_fp, model_genes)
+    run_search = alignment.run_blastn
+    if alignment_cache:
+        run_search = functools.partial(alignment.run_alignment_cached, run_search, cache_dir=alignment_cache)
+    blastn_model_all = run_search(ref_genes_model_fp, iso_fasta_fp, **{**alignment_options, 'prefilter': False})
+
+    results = list()
+    for alignment_thresholds in threshold_points:
+        blastp_iso = alignment.filter_results(blastp_iso_all, **alignment_thresholds)
+        blastp_ref = alignment.filter_results(blastp_ref_all, **alignment_thresholds)
+        model_orthologs = discover_orthologs(blastp_ref, blastp_iso)
+        if identical_orthologs:
+            model_orthologs = merge_orthologs(ref_proteins_fp, identical_orthologs, model_orthologs)
+        model_genes_no_orth = model_genes.difference(set(model_orthologs))
+        blastn_res_all = alignment.subset_results(blastn_model_all, model_genes_no_orth)
+        blastn_res = alignment.filter_results(blastn_res_all, **BlastnThresholds)
+        model_orthologs, unannotated_sequences = discover_unannotated_orthologs(
+            blastn_res, iso_sequences, model_orthologs
+        )
+        blast_results = {
+            'blastp_iso': blastp_iso_all,
+            'blastp_ref': blastp_ref_all,
+            'blastn': blastn_res_all,
+            'exact': identical_orthologs,
+        }
+        results.append((model_orthologs, blast_results, unannotated_sequences))
+
+    # Explicitly remove temp directory
+    dh.cleanup()
+    return results
+
+
+def prepare_protein_queries(iso_proteins_fp, ref_proteins_fp, dirpath, exact_match):
+    # Optionally assign proteins with identical sequences as orthologs and only query the remainder with BLASTp.
+    # Databases retain all proteins so that best hits of the remaining queries are unchanged
+    identical_orthologs = dict()
+    iso_query_fp = iso_proteins_fp
+    ref_query_fp = ref_proteins_fp
+    if exact_match:
+        identical_orthologs = discover_identical_orthologs(ref_proteins_fp, iso_proteins_fp)
+        print(f'Resolved {len(identical_orthologs)} orthologs by exact sequence match')
+        iso_query_fp = pathlib.Path(dirpath, 'isolate_proteins_query.fasta')
+        ref_query_fp = pathlib.Path(dirpath, 'reference_proteins_query.fasta')
+        util.write_fasta_subset(iso_proteins_fp, iso_query_fp, set(identical_orthologs.values()), exclude=True)
+        util.write_fasta_subset(ref_proteins_fp, ref_query_fp, set(identical_orthologs), exclude=True)
+    return identical_orthologs, iso_query_fp, ref_query_fp
+
+
+def exclude_identical_queries(blastp_results, identical_orthologs):
+    # Provided results are of all proteins. Remove hits of those assigned by exact sequence match, as if only the
+    # remainder had been queried
+    blastp_iso_all, blastp_ref_all = blastp_results
+    if identical_orthologs:
+        iso_queries = set(blastp_iso_all).difference(identical_orthologs.values())
+        ref_queries = set(blastp_ref_all).difference(identical_orthologs)
+        blastp_iso_all = alignment.subset_results(blastp_iso_all, iso_queries)
+        blastp_ref_all = alignment.subset_results(blastp_ref_all, ref_queries)
+    return blastp_iso_all, blastp_ref_all
+
+
+def run_blastp_bidirectional(
+    iso_fasta_fp,
+    iso_proteins_fp,
+    iso_query_fp,
+    ref_proteins_fp,
+    ref_query_fp,
+    alignment_thresholds,
+    alignment_options,
+    aligner,
+):
+    # Both search directions are independent so run them concurrently, sharing available threads, and create the
+    # isolate nucleotide database for BLASTn in the meantime. Hits are filtered as they are read and
+    # all hits are spilled to disk for the troubleshooter
+    run_protein_search = alignment.ProteinAligners[aligner]
+    search_options = {**alignment_options, 'threads': max(alignment_options['threads'] // 2, 1)}
+    blastp_iso_all = alignment.SpilledResults()
+    blastp_ref_all = alignment.SpilledResults()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        blastp_iso_job = executor.submit(
+            run_protein_search,
+            iso_query_fp,
+            ref_proteins_fp,
+            thresholds=alignment_thresholds,
+            spill=blastp_iso_all,
+            **search_options,
+        )
+        blastp_ref_job = executor.submit(
+            run_protein_search,
+            ref_query_fp,
+            iso_proteins_fp,
+            thresholds=alignment_thresholds,
+            spill=blastp_ref_all,
+            **search_options,
+        )
+        iso_fasta_job = executor.submit(alignment.create_blast_database, iso_fasta_fp, 'nucl')
+        blastp_iso = blastp_iso_job.result()
+        blastp_ref = blastp_ref_job.result()
+        iso_fasta_job.result()
+    return blastp_iso, blastp_ref, blastp_iso_all, blastp_ref_all
+
+
+def run_blastp_bidirectional_unfiltered(
+    iso_fasta_fp,
+    iso_proteins_fp,
+    iso_query_fp,
+    ref_proteins_fp,
+    ref_query_fp,
+    alignment_options,
+    aligner,
+    alignment_cache,
+):
+    # As above but hits are retained in memory without filtering, retrieving them from the cache where possible
+    run_search = alignment.ProteinAligners[aligner]
+    if alignment_cache:
+        run_search = functools.partial(alignment.run_alignment_cached, run_search, cache_dir=alignment_cache)
+    search_options = {**alignment_options, 'threads': max(alignment_options['threads'] // 2, 1), 'prefilter': False}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        blastp_iso_job = executor.submit(run_search, iso_query_fp, ref_proteins_fp, **search_options)
+        blastp_ref_job = executor.submit(run_search, ref_query_fp, iso_proteins_fp, **search_options)
+        iso_fasta_job = executor.submit(alignment.create_blast_database, iso_fasta_fp, 'nucl')
+        blastp_iso_all = blastp_iso_job.result()
+        blastp_ref_all = blastp_ref_job.result()
+        iso_fasta_job.result()
+    return blastp_iso_all, blastp_ref_all
+
+
+def discover_identical_orthologs(ref_proteins_fp, iso_proteins_fp):
+    # Pair proteins whose sequence occurs exactly once in each of the reference and isolate
+    ref_sequences = util.read_fasta_by_sequence(ref_proteins_fp)
+    iso_sequences = util.read_fasta_by_sequence(iso_proteins_fp)
+    identical_orthologs = dict()
+    for seq, ref_descs in ref_sequences.items():
+        iso_descs = iso_sequences.get(seq, list())
+        if len(ref_descs) == 1 and len(iso_descs) == 1:
+            identical_orthologs[ref_descs[0]] = iso_descs[0]
+    return identical_orthologs
+
+
+def merge_orthologs(ref_proteins_fp, *orthologs_sets):
+    with ref_proteins_fp.open('r') as fh:
+        ref_descs = [desc for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh)]
     model_orthologs = dict()
-    for ref_gene_name, hits in blastp_ref.items():
-        # Get the best hit in isolate for this reference protein
-        best_iso_hit = max(hits, key=lambda k: k.pident)
-        # For the isolate protein collect the best hit in the reference, if any
-        if best_iso_hit.sseqid not in blastp_iso:
-            continue
-        best_ref_hit = max(blastp_iso[best_iso_hit.sseqid], key=lambda k: k.pident)
-        # If they are reciprocal consider them orthologous
-        if best_ref_hit.sseqid == ref_gene_name:
-            model_orthologs[ref_gene_name] = best_ref_hit.qseqid
+    for desc in ref_descs:
+        for orthologs in orthologs_sets:
+            if desc in orthologs:
+                model_orthologs[desc] = orthologs[desc]
     return model_orthologs
 
 
-def discover_unannotated_orthologs(blastn_res, iso_fasta_fp, model_orthologs):
+def discover_orthologs(blastp_ref, blastp_iso):
+    # Get the best hit in isolate for each reference protein, and in reference for each isolate protein
+    best_iso_hits = blastp_ref.best_hits()
+    best_ref_hits = blastp_iso.best_hits()
+    # Join directions on isolate protein; reference proteins with a reciprocated best hit are orthologous
+    reciprocal = np.zeros(len(best_iso_hits), dtype=bool)
+    if len(best_ref_hits):
+        iso_order = np.argsort(best_ref_hits.qseqid)
+        iso_positions = np.searchsorted(best_ref_hits.qseqid, best_iso_hits.sseqid, sorter=iso_order)
+        iso_indices = iso_order[np.minimum(iso_positions, len(iso_order) - 1)]
+        reciprocal = (best_ref_hits.qseqid[iso_indices] == best_iso_hits.sseqid) & (
+            best_ref_hits.sseqid[iso_indices] == best_iso_hits.qseqid
+        )
+    return dict(zip(best_iso_hits.qseqid[reciprocal].tolist(), best_iso_hits.sseqid[reciprocal].tolist()))
+
+
+def discover_unannotated_orthologs(blastn_res, iso_sequences, model_orthologs):
     # pylint: disable=no-else-continue
-    with iso_fasta_fp.open('r') as fh:
-        iso_fasta = {des: Bio.Seq.Seq(seq) for des, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh)}
     unannotated_sequences = []
     for ref_gene_name, hits in blastn_res.items():
         assert ref_gene_name not in model_orthologs
         for hit in hits:
             # Get nucleotide sequence and check for premature stop codons
-            nucleotide_seq = util.extract_nucleotides_from_ref(hit, iso_fasta)
+            nucleotide_seq = util.extract_nucleotides_from_ref(hit, iso_sequences)
             # Append trailing N if we have a partial codon
             seq_n = (3 - len(nucleotide_seq)) % 3
             nucleotide_seq = nucleotide_seq + 'N' * seq_n
@@ -2,12 +2,10 @@ import itertools
 import json
 import sys
 
-import cobra.io
-from cobra.io import read_sbml_model
-
 
 from . import fba
 from . import package_data
+from . import util
 
 
 def run(config):
@@ -16,11 +14,7 @@ def run(config):
     print('running FBA on ' + config.model_fp.stem)
     print('========================================')
     # Read in model and spec
-    with config.model_fp.open('r') as fh:
-        if config.model_fp.suffix == '.json':
-            model = cobra.io.load_json_model(fh)
-        elif config.model_fp.suffix == '.xml':
-            model = read_sbml_model(fh)
+    model = util.read_model(config.model_fp, cache_dir=config.model_cache, cache_size=config.model_cache_size)
     if config.fba_spec_fp:
         spec = parse_spec(config.fba_spec_fp)
     elif config.fba_spec_name:
@@ -1,10 +1,10 @@
 import sys
 
 import cobra.flux_analysis
-import cobra.io
 
 
 from . import package_data
+from . import util
 
 
 def run(config):
@@ -12,15 +12,7 @@ def run(config):
     print('running SGK on ' + config.model_fp.stem)
     print('========================================')
     # Load model
-    with config.model_fp.open('r') as fh:
-        if config.model_fp.name.endswith('.sbml'):
-            model, _ = cobra.io.validate_sbml_model(fh)
-        elif config.model_fp.name.endswith('.json'):
-            model = cobra.io.load_json_model(fh)
-        elif config.model_fp.name.endswith('.xml'):
-            model = cobra.io.read_sbml_model(fh)
-        else:
-            assert False
+    model = util.read_model(config.model_fp, cache_dir=config.model_cache, cache_size=config.model_cache_size)
 
     # Set growth environment
     # NOTE(SW): returning to be explicit about in-place modification
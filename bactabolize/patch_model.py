@@ -1,9 +1,6 @@
 import json
 import sys
 
-import cobra.io
-from cobra.io import read_sbml_model
-
 
 from . import package_data
 from . import util
@@ -15,17 +12,9 @@ def run(config):
     print('Patching model ' + config.draft_model_fp.stem)
     print('========================================')
     # Read in models and patch file
-    with config.draft_model_fp.open('r') as fh:
-        if config.draft_model_fp.suffix == '.json':
-            model_draft = cobra.io.load_json_model(fh)
-        elif config.draft_model_fp.suffix == '.xml':
-            model_draft = read_sbml_model(fh)
-
-    with config.ref_model_fp.open('r') as fh:
-        if config.ref_model_fp.suffix == '.json':
-            model_ref = cobra.io.load_json_model(fh)
-        elif config.ref_model_fp.suffix == '.xml':
-            model_ref = read_sbml_model(fh)
+    cache_options = {'cache_dir': config.model_cache, 'cache_size': config.model_cache_size}
+    model_draft = util.read_model(config.draft_model_fp, **cache_options)
+    model_ref = util.read_model(config.ref_model_fp, **cache_options)
 
     patch = parse_patch(config.patch_fp, model_draft.id)
     # Apply patch
@@ -50,10 +39,15 @@ def run(config):
     #        else:
     #            print(f'error: got bad operation {op} for {metabolite_id}', file=sys.stderr)
     #            sys.exit(1)
-    # Write model to disk
-    with config.output_fp.open('w') as fh:
-        cobra.io.save_json_model(model_draft, fh)
-        cobra.io.write_sbml_model(model_draft, str(config.output_fp).rsplit('.', 1)[0] + '.xml')  # .xml output
+    # Write model to disk while checking the model
+    model_write = util.write_model_background(model_draft, config.output_fp, config.output_formats)
+    try:
+        check_model(config, model_draft)
+    finally:
+        util.finish_model_write(model_write)
+
+
+def check_model(config, model_draft):
     # Check if model now optimises on set media
     for reaction in model_draft.exchanges:
         reaction.lower_bound = 0
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import pickle
+import shutil
+import sys
+
+
+import Bio.SeqIO.FastaIO
+import cobra
+import cobra.io
+
+
+from . import __version__
+from . import alignment
+from . import util
+
+
+# Incremented whenever bundle contents change so that outdated bundles are rejected rather than misread
+BundleVersion = 1
+
+
+def run(config):
+    print('\n========================================')
+    print('preparing reference bundle ' + str(config.output_dir))
+    print('========================================')
+    config.output_dir.mkdir(parents=True, exist_ok=True)
+    # Remove any existing manifest first, a bundle is only considered complete once its manifest is written
+    manifest_fp = config.output_dir / 'manifest.json'
+    manifest_fp.unlink(missing_ok=True)
+    # Remove databases of any previous bundle, which would otherwise be considered current and not rebuilt
+    for database_fp in config.output_dir.glob('ref_proteins.fasta.*'):
+        database_fp.unlink()
+    # Write reference sequences
+    genes_fp = config.output_dir / 'ref_genes.fasta'
+    proteins_fp = config.output_dir / 'ref_proteins.fasta'
+    if config.ref_genbank_fp:
+        util.extract_genbank_coding(config.ref_genbank_fp, genes_fp=genes_fp, proteins_fp=proteins_fp)
+        source_fps = {'ref_model_fp': config.ref_model_fp, 'ref_genbank_fp': config.ref_genbank_fp}
+    else:
+        shutil.copyfile(config.ref_genes_fp, genes_fp)
+        shutil.copyfile(config.ref_proteins_fp, proteins_fp)
+        source_fps = {
+            'ref_model_fp': config.ref_model_fp,
+            'ref_genes_fp': config.ref_genes_fp,
+            'ref_proteins_fp': config.ref_proteins_fp,
+        }
+    # Read and check model against reference sequences, retaining results to report when the bundle is used
+    model = util.read_model(config.ref_model_fp)
+    model_genes = {gene.id for gene in model.genes}
+    gene_lengths = read_sequence_lengths(genes_fp)
+    protein_lengths = read_sequence_lengths(proteins_fp)
+    validation = {
+        'genes': sorted(util.check_genes_proteins(model_genes, set(gene_lengths), 'genes')),
+        'proteins': sorted(util.check_genes_proteins(model_genes, set(protein_lengths), 'proteins')),
+    }
+    write_gene_index(model_genes, gene_lengths, protein_lengths, config.output_dir / 'gene_index.tsv')
+    # Store the model serialised for fast loading and as JSON should the installed COBRApy differ at load time
+    with (config.output_dir / 'model.pickle').open('wb') as fh:
+        pickle.dump(model, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    cobra.io.save_json_model(model, str(config.output_dir / 'model.json'))
+    # Create protein database for the selected aligner. Reference genes are only used as queries
+    if config.aligner == 'blast':
+        alignment.create_blast_database(proteins_fp, 'prot')
+    elif config.aligner == 'diamond':
+        alignment.create_diamond_database(proteins_fp)
+    else:
+        assert False
+    # Write manifest
+    sources = dict()
+    for name, filepath in source_fps.items():
+        hasher = hashlib.sha256()
+        util.hash_file(filepath, hasher)
+        sources[name] = {'filepath': str(filepath.absolute()), 'sha256': hasher.hexdigest()}
+    manifest = {
+        'bundle_version': BundleVersion,
+        'bactabolize_version': __version__,
+        'cobra_version': cobra.__version__,
+        'model_id': model.id,
+        'aligner': config.aligner,
+        'sources': sources,
+        'counts': {
+            'model_genes': len(model_genes),
+            'model_reactions': len(model.reactions),
+            'reference_genes': len(gene_lengths),
+            'reference_proteins': len(protein_lengths),
+        },
+        'validation': validation,
+    }
+    with manifest_fp.open('w') as fh:
+        json.dump(manifest, fh, indent=2)
+    print(f'Wrote reference bundle to {config.output_dir}')
+
+
+def load(config):
+    print('\n========================================')
+    print('reading reference bundle ' + str(config.ref_bundle))
+    print('========================================')
+    manifest = read_manifest(config.ref_bundle)
+    # Bundles are only read so that they can be shared, databases for another aligner are not created within them
+    if manifest['aligner'] != config.aligner:
+        msg = (
+            f'error: reference bundle {config.ref_bundle} was prepared for {manifest["aligner"]}, rerun '
+            f'prepare_reference with --aligner {config.aligner}'
+        )
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    print('Ignore missing spontaneous reactions such as KPN_SPONT - no associated genes')
+    for other_type, missing in manifest['validation'].items():
+        util.report_missing_genes(missing, other_type)
+    config.model_ref_genes_fp = config.ref_bundle / 'ref_genes.fasta'
+    config.model_ref_proteins_fp = config.ref_bundle / 'ref_proteins.fasta'
+    # Pickled models are only loaded with the COBRApy version that created them
+    if manifest['cobra_version'] == cobra.__version__:
+        with (config.ref_bundle / 'model.pickle').open('rb') as fh:
+            config.model = pickle.load(fh)
+    else:
+        config.model = util.read_model(config.ref_bundle / 'model.json')
+
+
+def read_manifest(bundle_dir):
+    manifest_fp = bundle_dir / 'manifest.json'
+    if not manifest_fp.exists():
+        print(f'error: {bundle_dir} is not a complete reference bundle, rerun prepare_reference', file=sys.stderr)
+        sys.exit(1)
+    with manifest_fp.open('r') as fh:
+        manifest = json.load(fh)
+    if manifest['bundle_version'] != BundleVersion:
+        msg = (
+            f'error: reference bundle {bundle_dir} has version {manifest["bundle_version"]} but version '
+            f'{BundleVersion} is required, rerun prepare_reference'
+        )
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    return manifest
+
+
+def read_sequence_lengths(fasta_fp):
+    with fasta_fp.open('r') as fh:
+        return {desc: len(seq) for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh)}
+
+
+def write_gene_index(model_genes, gene_lengths, protein_lengths, output_fp):
+    with output_fp.open('w') as fh:
+        print('gene', 'in_model', 'gene_length', 'protein_length', sep='\t', file=fh)
+        for gene in sorted(model_genes | set(gene_lengths) | set(protein_lengths)):
+            in_model = 'yes' if gene in model_genes else 'no'
+            gene_length = gene_lengths.get(gene, 'NA')
+            protein_length = protein_lengths.get(gene, 'NA')
+            print(gene, in_model, gene_length, protein_length, sep='\t', file=fh)
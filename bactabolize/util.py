@@ -1,27 +1,30 @@
 import contextlib
+import functools
+import hashlib
+import multiprocessing
 import pathlib
+import pickle
+import re
 import subprocess
 import sys
+import tempfile
 import os
 
 
 import Bio.SeqIO
 import Bio.SeqIO.FastaIO
+import cobra
 import cobra.io
 from cobra.io import read_sbml_model
 import memote
 
 
-def read_model_and_check(model_fp, genes_fp, proteins_fp):
+def read_model_and_check(model_fp, genes_fp, proteins_fp, *, cache_dir=None, cache_size=None):
     print('\n========================================')
     print('reading reference ' + os.path.splitext(os.path.basename(model_fp))[0] + ' model')
     print('========================================')
     print('Ignore missing spontaneous reactions such as KPN_SPONT - no associated genes')
-    with model_fp.open('r') as fh:
-        if model_fp.suffix == '.json':
-            model = cobra.io.load_json_model(fh)
-        elif model_fp.suffix == '.xml':
-            model = read_sbml_model(fh)
+    model = read_model(model_fp, cache_dir=cache_dir, cache_size=cache_size)
     # Collect genes/proteins
     model_genes = {gene.id for gene in model.genes}
     with genes_fp.open('r') as fh:
@@ -34,8 +37,113 @@ def read_model_and_check(model_fp, genes_fp, proteins_fp):
     return model
 
 
+def read_model(model_fp, *, cache_dir=None, cache_size=None):
+    if not cache_dir:
+        return parse_model(model_fp)
+    # Cached models are keyed by file content, format and COBRApy version so that edited, renamed or copied model
+    # files and COBRApy upgrades are all handled without explicit invalidation
+    hasher = hashlib.sha256(f'{model_fp.suffix} {cobra.__version__}'.encode())
+    hash_file(model_fp, hasher)
+    cache_fp = pathlib.Path(cache_dir, f'{hasher.hexdigest()}.pickle')
+    try:
+        with cache_fp.open('rb') as fh:
+            model = pickle.load(fh)
+        # Record use for least recently used eviction, which is not possible in a read-only cache
+        try:
+            os.utime(cache_fp)
+        except OSError:
+            pass
+        return model
+    except FileNotFoundError:
+        pass
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as err:
+        print(f'warning: ignoring unreadable model cache entry {cache_fp}: {err}', file=sys.stderr)
+    model = parse_model(model_fp)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open_atomic(cache_fp) as fh:
+        pickle.dump(model, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    if cache_size is not None:
+        evict_model_cache(cache_dir, cache_size * 1024**2, cache_fp)
+    return model
+
+
+def parse_model(model_fp):
+    with model_fp.open('r') as fh:
+        if model_fp.suffix == '.json':
+            model = cobra.io.load_json_model(fh)
+        elif model_fp.suffix == '.xml':
+            model = read_sbml_model(fh)
+        elif model_fp.suffix == '.sbml':
+            model, _ = cobra.io.validate_sbml_model(fh)
+        else:
+            assert False
+    return model
+
+
+def evict_model_cache(cache_dir, max_bytes, current_fp):
+    # Remove least recently used entries until the cache fits, entries may be concurrently removed by other runs. The
+    # entry just written is always retained, even if larger than the cache size on its own
+    entries = list()
+    for cache_fp in cache_dir.glob('*.pickle'):
+        try:
+            stat = cache_fp.stat()
+        except FileNotFoundError:
+            continue
+        if cache_fp == current_fp:
+            max_bytes -= stat.st_size
+            if max_bytes < 0:
+                print(f'warning: model cache size is smaller than model cache entry {cache_fp}', file=sys.stderr)
+            continue
+        entries.append((stat, cache_fp))
+    entries.sort(key=lambda entry: entry[0].st_mtime_ns)
+    total_bytes = sum(stat.st_size for stat, cache_fp in entries)
+    for stat, cache_fp in entries:
+        if total_bytes <= max_bytes:
+            break
+        cache_fp.unlink(missing_ok=True)
+        total_bytes -= stat.st_size
+
+
+def write_model(model, output_fp, output_formats):
+    # JSON is written to the output filepath and SBML alongside it with an .xml extension
+    if 'json' in output_formats:
+        with output_fp.open('w') as fh:
+            cobra.io.save_json_model(model, fh)
+    if 'sbml' in output_formats:
+        cobra.io.write_sbml_model(model, str(output_fp).rsplit('.', 1)[0] + '.xml')  # .xml output
+
+
+def write_model_background(model, output_fp, output_formats):
+    # Write from a forked process, which holds a snapshot of the model so that it can be modified while written.
+    # Daemonic processes cannot have children, in which case the model is written before returning
+    if multiprocessing.current_process().daemon:
+        write_model(model, output_fp, output_formats)
+        return None
+    # Flush output so that buffered text is not duplicated in the forked process
+    sys.stdout.flush()
+    sys.stderr.flush()
+    context = multiprocessing.get_context('fork')
+    process = context.Process(target=write_model, args=(model, output_fp, output_formats))
+    process.start()
+    return process
+
+
+def finish_model_write(process):
+    if process is None:
+        return
+    process.join()
+    if process.exitcode != 0:
+        print('error: failed to write model files', file=sys.stderr)
+        sys.exit(1)
+
+
 def check_genes_proteins(model_genes, other_genes, other_type):
     missing = model_genes.difference(other_genes)
+    report_missing_genes(missing, other_type)
+    return missing
+
+
+def report_missing_genes(missing, other_type):
     if missing:
         plurality = 'entry' if len(missing) == 1 else 'entries'
         if len(missing) > 10:
@@ -46,8 +154,9 @@ def check_genes_proteins(model_genes, other_genes, other_type):
             print(msg, ', '.join(missing), file=sys.stderr)
 
 
+@functools.cache
 def determine_assembly_filetype(filepath):
-    accepted_types = ('genbank', 'fasta')
+    # Verdicts are cached per path so that repeated checks within a run neither reparse the file nor repeat warnings
     expected_map = {
         'fasta': 'fasta',
         'fna': 'fasta',
@@ -57,6 +166,41 @@ def determine_assembly_filetype(filepath):
     }
     file_extension = filepath.suffix[1:]
     expected_filetype = expected_map.get(file_extension, 'unknown')
+    filetype = sniff_assembly_filetype(filepath)
+    if not filetype:
+        filetype = parse_assembly_filetype(filepath)
+    if expected_filetype != filetype:
+        msg = f'warning: parsed {filepath} as {filetype}'
+        if expected_filetype == 'unknown':
+            print(f'{msg} but had an unknown file extension (.{file_extension})', file=sys.stderr)
+        else:
+            print(f'{msg} but expected {expected_filetype}', file=sys.stderr)
+    return filetype
+
+
+def sniff_assembly_filetype(filepath, sniff_size=4096):
+    # Identify filetype from the first lines only, returning None where these are not conclusive
+    with filepath.open('rb') as fh:
+        data = fh.read(sniff_size)
+    try:
+        lines = data.decode('utf-8').lstrip().splitlines()
+    except UnicodeDecodeError:
+        return None
+    # Only consider complete lines unless the entire file was read
+    if len(data) == sniff_size:
+        lines = lines[:-1]
+    if len(lines) < 2:
+        return None
+    genbank_keywords = ('DEFINITION', 'ACCESSION', 'VERSION', 'KEYWORDS', 'SOURCE', 'FEATURES', 'ORIGIN')
+    if lines[0].startswith('LOCUS ') and lines[1].startswith(genbank_keywords):
+        return 'genbank'
+    if lines[0].startswith('>') and re.fullmatch(r'[A-Za-z*-]+', lines[1].strip()):
+        return 'fasta'
+    return None
+
+
+def parse_assembly_filetype(filepath):
+    accepted_types = ('genbank', 'fasta')
     for filetype in accepted_types:
         with filepath.open('r') as fh:
             if list(Bio.SeqIO.parse(fh, filetype)):
@@ -64,43 +208,57 @@ def determine_assembly_filetype(filepath):
     else:
         print(f'error: could not parse {filepath} as either GenBank or FASTA format', file=sys.stderr)
         sys.exit(1)
-    if expected_filetype != filetype:
-        msg = f'warning: parsed {filepath} as {filetype}'
-        if expected_filetype == 'unknown':
-            print(f'{msg} but had an unknown file extension (.{file_extension})', file=sys.stderr)
-        else:
-            print(f'{msg} but expected {expected_filetype}', file=sys.stderr)
     return filetype
 
 
 def write_genbank_coding(filepath, output_fp, *, seq_type):
-    # pylint: disable=too-many-branches
+    if seq_type == 'prot':
+        extract_genbank_coding(filepath, proteins_fp=output_fp)
+    elif seq_type == 'nucl':
+        extract_genbank_coding(filepath, genes_fp=output_fp)
+    else:
+        assert False
+    return output_fp
+
+
+def extract_genbank_coding(filepath, *, genes_fp=None, proteins_fp=None, records=None):
+    # Parse genbank once, writing coding gene and protein sequences as FASTA and indexing gene sequences by locus tag.
+    # Records already read from the genbank can be provided to avoid parsing it
+    gene_sequences = dict()
     with contextlib.ExitStack() as stack:
-        fh_in = stack.enter_context(filepath.open('r'))
-        fh_out = stack.enter_context(output_fp.open('w'))
+        if records is None:
+            fh_in = stack.enter_context(filepath.open('r'))
+            records = Bio.SeqIO.parse(fh_in, 'genbank')
+        fh_genes = stack.enter_context(genes_fp.open('w')) if genes_fp else None
+        fh_proteins = stack.enter_context(proteins_fp.open('w')) if proteins_fp else None
         # Iterate coding features
-        for record in Bio.SeqIO.parse(fh_in, 'genbank'):
+        for record in records:
             for feature in iterate_coding_features(record):
+                [locus_tag] = feature.qualifiers['locus_tag']
                 nucleotide_seq = feature.extract(record.seq)
-                if seq_type == 'prot':
-                    if 'translation' not in feature.qualifiers:
-                        # Append trailing N if we have a partial codon
-                        seq_n = (3 - len(nucleotide_seq)) % 3
-                        nucleotide_seq = nucleotide_seq + 'N' * seq_n
-                        seq = nucleotide_seq.translate(stop_symbol='')
-                    else:
-                        [seq] = feature.qualifiers['translation']
-                elif seq_type == 'nucl':
-                    seq = nucleotide_seq
-                else:
-                    assert False
+                gene_sequences[locus_tag] = nucleotide_seq
                 # Write to disk
-                [locus_tag] = feature.qualifiers['locus_tag']
-                desc = f'>{locus_tag}'
-                seq_lines = [seq[i : i + 80] for i in range(0, len(seq), 80)]
-                print(desc, file=fh_out)
-                print(*seq_lines, sep='\n', file=fh_out)
-    return output_fp
+                if fh_genes:
+                    write_fasta_record(locus_tag, nucleotide_seq, fh_genes)
+                if fh_proteins:
+                    write_fasta_record(locus_tag, translate_coding_feature(feature, nucleotide_seq), fh_proteins)
+    return gene_sequences
+
+
+def translate_coding_feature(feature, nucleotide_seq):
+    if 'translation' in feature.qualifiers:
+        [seq] = feature.qualifiers['translation']
+        return seq
+    # Append trailing N if we have a partial codon
+    seq_n = (3 - len(nucleotide_seq)) % 3
+    nucleotide_seq = nucleotide_seq + 'N' * seq_n
+    return nucleotide_seq.translate(stop_symbol='')
+
+
+def write_fasta_record(desc, seq, fh):
+    seq_lines = [seq[i : i + 80] for i in range(0, len(seq), 80)]
+    print(f'>{desc}', file=fh)
+    print(*seq_lines, sep='\n', file=fh)
 
 
 def write_genbank_seq(filepath, dirpath):
@@ -118,6 +276,50 @@ def write_genbank_seq(filepath, dirpath):
     return pathlib.Path(fasta_fp)
 
 
+def write_fasta_subset(input_fp, output_fp, descs, *, exclude=False):
+    with contextlib.ExitStack() as stack:
+        fh_in = stack.enter_context(input_fp.open('r'))
+        fh_out = stack.enter_context(output_fp.open('w'))
+        for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh_in):
+            if (desc in descs) == exclude:
+                continue
+            print(f'>{desc}', file=fh_out)
+            print(*[seq[i : i + 80] for i in range(0, len(seq), 80)], sep='\n', file=fh_out)
+    return output_fp
+
+
+def read_fasta_by_sequence(filepath):
+    # Map normalised sequences to the descriptions of all records that share them
+    sequences = dict()
+    with filepath.open('r') as fh:
+        for desc, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(fh):
+            seq = seq.upper().rstrip('*')
+            if seq not in sequences:
+                sequences[seq] = list()
+            sequences[seq].append(desc)
+    return sequences
+
+
+@contextlib.contextmanager
+def open_atomic(output_fp):
+    # Write via a uniquely named temporary file then replace the output, so that concurrent runs never read a
+    # partially written file
+    with tempfile.NamedTemporaryFile('wb', dir=output_fp.parent, suffix='.tmp', delete=False) as fh:
+        try:
+            yield fh
+        except BaseException:
+            fh.close()
+            pathlib.Path(fh.name).unlink()
+            raise
+    pathlib.Path(fh.name).replace(output_fp)
+
+
+def hash_file(filepath, hasher):
+    with filepath.open('rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            hasher.update(chunk)
+
+
 def iterate_coding_features(record):
     for feature in record.features:
         if feature.type != 'CDS':
@@ -144,6 +346,18 @@ def execute_command(command):
     return result
 
 
+def stream_command(command):
+    # Yield stdout lines as they are produced; stderr is buffered to disk to avoid blocking on a full pipe
+    with tempfile.TemporaryFile('w+') as fh_err:
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=fh_err, shell=True, encoding='utf-8') as process:
+            yield from process.stdout
+        if process.returncode != 0:
+            fh_err.seek(0)
+            print('Failed to run command:', process.args, file=sys.stderr)
+            print('stderr:', fh_err.read(), file=sys.stderr)
+            sys.exit(1)
+
+
 def generate_memote_report(model, output_fp):
     print('Running MEMOTE')
     result = memote.test_model(model, results=True, pytest_args=['-qq'])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+
+from bactabolize import alignment
+from bactabolize import draft_model
+from bactabolize import util
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Compare orthologs identified using each protein aligner')
+    parser.add_argument('--ref_genbank_fp', type=pathlib.Path, required=True, help='Reference genbank filepath')
+    parser.add_argument(
+        '--assembly_fps', type=pathlib.Path, nargs='+', required=True, help='Annotated isolate genbank filepaths'
+    )
+    parser.add_argument('--min_coverage', type=float, default=25, help='Alignment minimum coverage [default: 25]')
+    parser.add_argument('--min_pident', type=float, default=80, help='Alignment minimum pident [default: 80]')
+    parser.add_argument('--min_ppos', type=float, help='Alignment minimum ppos')
+    parser.add_argument('--threads', type=int, default=1, help='Number of threads to use for alignment [default: 1]')
+    parser.add_argument('--output_fp', type=pathlib.Path, default=sys.stdout, help='Output filepath [default: stdout]')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    alignment_thresholds = {
+        'min_coverage': args.min_coverage,
+        'min_pident': args.min_pident,
+        'min_ppos': args.min_ppos,
+    }
+    alignment_options = {'threads': args.threads}
+    with tempfile.TemporaryDirectory() as dirpath:
+        ref_proteins_fp = pathlib.Path(dirpath, 'ref_proteins.fasta')
+        util.write_genbank_coding(args.ref_genbank_fp, ref_proteins_fp, seq_type='prot')
+        rows = list()
+        for i, assembly_fp in enumerate(args.assembly_fps):
+            # Write to a new file for each assembly as databases are only created if absent
+            iso_proteins_fp = pathlib.Path(dirpath, f'isolate_{i}_proteins.fasta')
+            util.write_genbank_coding(assembly_fp, iso_proteins_fp, seq_type='prot')
+            orthologs = dict()
+            runtimes = dict()
+            for aligner in alignment.ProteinAligners:
+                time_start = time.perf_counter()
+                orthologs[aligner] = run_orthologs(
+                    aligner, ref_proteins_fp, iso_proteins_fp, alignment_thresholds, alignment_options
+                )
+                runtimes[aligner] = time.perf_counter() - time_start
+            rows.append(compare_orthologs(assembly_fp.stem, orthologs['blast'], orthologs['diamond'], runtimes))
+    fh = args.output_fp.open('w') if args.output_fp is not sys.stdout else sys.stdout
+    print(*rows[0], sep='\t', file=fh)
+    for row in rows:
+        print(*row.values(), sep='\t', file=fh)
+    if fh is not sys.stdout:
+        fh.close()
+
+
+def run_orthologs(aligner, ref_proteins_fp, iso_proteins_fp, alignment_thresholds, alignment_options):
+    run_protein_search = alignment.ProteinAligners[aligner]
+    blastp_iso = run_protein_search(
+        iso_proteins_fp, ref_proteins_fp, thresholds=alignment_thresholds, **alignment_options
+    )
+    blastp_ref = run_protein_search(
+        ref_proteins_fp, iso_proteins_fp, thresholds=alignment_thresholds, **alignment_options
+    )
+    return draft_model.discover_orthologs(blastp_ref, blastp_iso)
+
+
+def compare_orthologs(name, orthologs_blast, orthologs_diamond, runtimes):
+    ref_genes_shared = set(orthologs_blast) & set(orthologs_diamond)
+    agree = sum(orthologs_blast[gene] == orthologs_diamond[gene] for gene in ref_genes_shared)
+    pairs_total = len(set(orthologs_blast.items()) | set(orthologs_diamond.items()))
+    return {
+        'assembly': name,
+        'orthologs_blast': len(orthologs_blast),
+        'orthologs_diamond': len(orthologs_diamond),
+        'agree': agree,
+        'disagree': len(ref_genes_shared) - agree,
+        'blast_only': len(set(orthologs_blast) - ref_genes_shared),
+        'diamond_only': len(set(orthologs_diamond) - ref_genes_shared),
+        'agreement': f'{agree / pairs_total:.4f}' if pairs_total else 'NA',
+        'seconds_blast': f'{runtimes["blast"]:.2f}',
+        'seconds_diamond': f'{runtimes["diamond"]:.2f}',
+        'speedup': f'{runtimes["blast"] / runtimes["diamond"]:.1f}' if runtimes['diamond'] else 'NA',
+    }
+
+
+if __name__ == '__main__':
+    main()
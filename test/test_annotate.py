@@ -0,0 +1,69 @@
+import unittest
+
+
+import Bio.SeqFeature
+
+
+from bactabolize import annotate
+
+
+def create_feature(start, end, strand, name):
+    location = Bio.SeqFeature.FeatureLocation(start, end, strand=strand)
+    return Bio.SeqFeature.SeqFeature(location, type='CDS', qualifiers={'note': [name]})
+
+
+def discover_overlaps(features_new, features_existing, overlap_min=0.80):
+    contig_positions_new = annotate.create_positions({'contig_1': features_new}, 'new')
+    contig_positions_existing = annotate.create_positions({'contig_1': features_existing}, 'existing')
+    positions = contig_positions_new['contig_1'] + contig_positions_existing['contig_1']
+    return annotate.discover_overlaps(positions, overlap_min)
+
+
+class TestDiscoverOverlaps(unittest.TestCase):
+    def test_nested(self):
+        feature_new = create_feature(100, 1000, 1, 'new')
+        feature_existing = create_feature(150, 1000, 1, 'existing')
+        features_matched = discover_overlaps([feature_new], [feature_existing])
+        self.assertEqual(features_matched, [(feature_new, feature_existing)])
+        self.assertEqual(feature_new.qualifiers['note'], ['new;overlap:0.94'])
+        self.assertEqual(feature_existing.qualifiers['note'], ['existing'])
+
+    def test_nested_below_threshold(self):
+        feature_new = create_feature(100, 1100, 1, 'new')
+        feature_existing = create_feature(200, 600, 1, 'existing')
+        self.assertEqual(discover_overlaps([feature_new], [feature_existing]), list())
+        self.assertEqual(discover_overlaps([feature_existing], [feature_new]), list())
+        self.assertEqual(feature_new.qualifiers['note'], ['new'])
+
+    def test_adjacent(self):
+        feature_new = create_feature(100, 1000, 1, 'new')
+        feature_existing = create_feature(1000, 2000, 1, 'existing')
+        self.assertEqual(discover_overlaps([feature_new], [feature_existing]), list())
+        self.assertEqual(discover_overlaps([feature_existing], [feature_new]), list())
+
+    def test_strand(self):
+        feature_new = create_feature(100, 1000, 1, 'new')
+        feature_existing_reverse = create_feature(100, 1000, -1, 'existing_reverse')
+        feature_existing_forward = create_feature(110, 1000, 1, 'existing_forward')
+        features_matched = discover_overlaps([feature_new], [feature_existing_reverse, feature_existing_forward])
+        self.assertEqual(features_matched, [(feature_new, feature_existing_forward)])
+
+    def test_duplicate_existing_locations(self):
+        # Only the first of existing features sharing a location is matched
+        feature_new = create_feature(100, 1000, 1, 'new')
+        features_existing = [create_feature(100, 1000, 1, 'existing_1'), create_feature(100, 1000, 1, 'existing_2')]
+        features_matched = discover_overlaps([feature_new], features_existing)
+        self.assertEqual(features_matched, [(feature_new, features_existing[0])])
+        self.assertEqual(feature_new.qualifiers['note'], ['new;overlap:1.00'])
+
+    def test_multiple(self):
+        # Overlapping features across the contig, each matched only with its counterpart
+        features_new = [create_feature(0, 900, 1, 'new_1'), create_feature(800, 2000, -1, 'new_2')]
+        features_existing = [create_feature(30, 900, 1, 'existing_1'), create_feature(850, 2000, -1, 'existing_2')]
+        features_matched = discover_overlaps(features_new, features_existing)
+        expected = [(features_new[0], features_existing[0]), (features_new[1], features_existing[1])]
+        self.assertEqual(features_matched, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import importlib
+import unittest
+
+
+import cobra
+
+
+from bactabolize import draft_model
+
+
+def load_textbook_model():
+    # Test models moved from cobra.test to cobra.io.load_model in later COBRApy versions
+    if hasattr(cobra.io, 'load_model'):
+        return cobra.io.load_model('textbook')
+    return importlib.import_module('cobra.test').create_test_model('textbook')
+
+
+class TestCreateDraftModel(unittest.TestCase):
+    def setUp(self):
+        self.model = load_textbook_model()
+        self.model_genes = {gene.id for gene in self.model.genes}
+
+    def test_matches_copy_and_remove(self):
+        gene_sets = [
+            # No genes removed
+            set(),
+            # Reactions with a sole gene, or with all alternatives removed
+            {'b3919', 'b1136', 'b0351', 'b1241'},
+            # Rules simplified by removing some alternatives and part of a complex
+            {'b3916', 'b1478', 'b0727'},
+        ]
+        for missing_genes in gene_sets:
+            with self.subTest(missing_genes=sorted(missing_genes)):
+                model_expected = self.model.copy()
+                model_expected.id = 'draft'
+                cobra.manipulation.remove_genes(model_expected, missing_genes, remove_reactions=True)
+                isolate_orthologs = {gene: f'iso_{gene}' for gene in self.model_genes - missing_genes}
+                model_reference = cobra.io.model_to_dict(self.model)
+                model_draft = draft_model.create_draft_model(self.model, self.model_genes, isolate_orthologs, 'draft')
+                self.assertEqual(cobra.io.model_to_dict(model_draft), cobra.io.model_to_dict(model_expected))
+                self.assertEqual(cobra.io.model_to_dict(self.model), model_reference)
+                self.assertAlmostEqual(model_draft.slim_optimize(), model_expected.slim_optimize())
+                if missing_genes:
+                    self.assertLess(len(model_draft.reactions), len(self.model.reactions))
+
+
+if __name__ == '__main__':
+    unittest.main()
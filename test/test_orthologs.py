@@ -0,0 +1,67 @@
+import unittest
+
+
+from bactabolize import alignment
+from bactabolize import draft_model
+
+
+def create_hits(hits):
+    # Hits given as query, subject and pident, with other values fixed
+    lines = list()
+    for qseqid, sseqid, pident in hits:
+        line_tokens = (qseqid, sseqid, 100, 100, 1, 100, 1, 100, 100, '1e-10', 200, pident, pident, pident, 0, 0)
+        lines.append('\t'.join(str(token) for token in line_tokens) + '\n')
+    return alignment.parse_lines(lines)
+
+
+class TestDiscoverOrthologs(unittest.TestCase):
+    def test_reciprocal_best_hits(self):
+        blastp_ref = create_hits(
+            [
+                # Tied best hits, the first is selected
+                ('ref_a', 'iso_x', 90),
+                ('ref_a', 'iso_y', 90),
+                # Best hit is not the first
+                ('ref_b', 'iso_z', 80),
+                ('ref_b', 'iso_w', 85),
+                # Best hit is not reciprocated
+                ('ref_c', 'iso_v', 70),
+                # Hits of a query are not contiguous
+                ('ref_e', 'iso_u', 60),
+                ('ref_f', 'iso_t', 99),
+                ('ref_e', 'iso_s', 99),
+            ]
+        )
+        blastp_iso = create_hits(
+            [
+                ('iso_x', 'ref_a', 90),
+                ('iso_y', 'ref_a', 90),
+                ('iso_z', 'ref_b', 80),
+                ('iso_w', 'ref_b', 85),
+                ('iso_v', 'ref_d', 75),
+                ('iso_v', 'ref_c', 70),
+                ('iso_u', 'ref_e', 60),
+                ('iso_t', 'ref_f', 99),
+                ('iso_s', 'ref_e', 99),
+            ]
+        )
+        orthologs = draft_model.discover_orthologs(blastp_ref, blastp_iso)
+        expected = [('ref_a', 'iso_x'), ('ref_b', 'iso_w'), ('ref_e', 'iso_s'), ('ref_f', 'iso_t')]
+        self.assertEqual(list(orthologs.items()), expected)
+
+    def test_tied_reverse_hits(self):
+        # Isolate protein with tied best hits only reciprocates the first
+        blastp_ref = create_hits([('ref_a', 'iso_x', 95), ('ref_b', 'iso_x', 95)])
+        blastp_iso = create_hits([('iso_x', 'ref_b', 95), ('iso_x', 'ref_a', 95)])
+        orthologs = draft_model.discover_orthologs(blastp_ref, blastp_iso)
+        self.assertEqual(orthologs, {'ref_b': 'iso_x'})
+
+    def test_no_hits(self):
+        blastp_ref = create_hits([('ref_a', 'iso_x', 95)])
+        blastp_iso = create_hits(list())
+        self.assertEqual(draft_model.discover_orthologs(blastp_ref, blastp_iso), dict())
+        self.assertEqual(draft_model.discover_orthologs(blastp_iso, blastp_ref), dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
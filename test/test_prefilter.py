@@ -0,0 +1,120 @@
+import random
+import unittest
+
+
+import numpy as np
+
+
+from bactabolize import alignment
+from bactabolize import draft_model
+
+
+def create_hit_lines(seed):
+    # Alignments between reference and isolate proteins with internally consistent lengths and counts, mostly of high
+    # coverage and identity. Each is reported in both search directions with values rounded as by BLAST
+    rng = random.Random(seed)
+    ref_lengths = [rng.randint(50, 400) for _ in range(200)]
+    iso_lengths = [rng.randint(50, 400) for _ in range(200)]
+    ref_lines = list()
+    iso_lines = list()
+    for ref_n, ref_length in enumerate(ref_lengths):
+        for iso_n in rng.sample(range(len(iso_lengths)), rng.randint(1, 6)):
+            iso_length = iso_lengths[iso_n]
+            pairs = max(round(min(ref_length, iso_length) * rng.random() ** 0.3), 1)
+            ref_gaps = rng.randint(0, pairs // 20)
+            iso_gaps = rng.randint(0, pairs // 20)
+            length = pairs + ref_gaps + iso_gaps
+            positives = round(pairs * rng.random() ** 0.2)
+            nident = round(positives * rng.random() ** 0.3)
+            values = (length, round(nident / length * 100, 3), nident, round(positives / length * 100, 2))
+            mismatches_gaps = (pairs - nident, ref_gaps + iso_gaps)
+            ref_span = length - ref_gaps
+            iso_span = length - iso_gaps
+            ref_start = rng.randint(1, ref_length - ref_span + 1) if ref_span <= ref_length else None
+            iso_start = rng.randint(1, iso_length - iso_span + 1) if iso_span <= iso_length else None
+            if ref_start is None or iso_start is None:
+                continue
+            ref_coords = (ref_start, ref_start + ref_span - 1)
+            iso_coords = (iso_start, iso_start + iso_span - 1)
+            ref_line_tokens = (
+                f'ref_{ref_n}',
+                f'iso_{iso_n}',
+                ref_length,
+                iso_length,
+                *ref_coords,
+                *iso_coords,
+                values[0],
+                '1e-10',
+                nident * 2,
+                *values[1:],
+                *mismatches_gaps,
+            )
+            iso_line_tokens = (
+                f'iso_{iso_n}',
+                f'ref_{ref_n}',
+                iso_length,
+                ref_length,
+                *iso_coords,
+                *ref_coords,
+                values[0],
+                '1e-10',
+                nident * 2,
+                *values[1:],
+                *mismatches_gaps,
+            )
+            ref_lines.append('\t'.join(str(token) for token in ref_line_tokens) + '\n')
+            iso_lines.append('\t'.join(str(token) for token in iso_line_tokens) + '\n')
+    # Search output is ordered by query
+    iso_lines.sort(key=lambda line: int(line.split('\t', 1)[0].split('_')[1]))
+    return ref_lines, iso_lines
+
+
+def apply_prefilter_options(results, options):
+    # Emulate search-time limits: query coverage of each HSP and percent identity
+    hits = results.hits
+    options = dict(zip(options.split()[::2], (float(value) for value in options.split()[1::2])))
+    keep = np.ones(len(hits), dtype=bool)
+    qcov_hsp_perc = options.get('-qcov_hsp_perc', options.get('--query-cover'))
+    if qcov_hsp_perc is not None:
+        keep &= (hits.qend - hits.qstart + 1) / hits.qlen * 100 >= qcov_hsp_perc
+    perc_identity = options.get('-perc_identity', options.get('--id'))
+    if perc_identity is not None:
+        keep &= hits.pident >= perc_identity
+    return alignment.HitTable(hits[keep])
+
+
+class TestPrefilter(unittest.TestCase):
+    def setUp(self):
+        ref_lines, iso_lines = create_hit_lines(1)
+        self.blastp_ref = alignment.parse_lines(ref_lines)
+        self.blastp_iso = alignment.parse_lines(iso_lines)
+
+    def test_orthologs_unchanged(self):
+        threshold_sets = [
+            {'min_coverage': 25, 'min_pident': 80, 'min_ppos': None},
+            {'min_coverage': 50, 'min_pident': 30, 'min_ppos': 40},
+            {'min_coverage': 80, 'min_pident': None, 'min_ppos': 60},
+            {'min_coverage': 70, 'min_pident': 90, 'min_ppos': None},
+        ]
+        for program in ('blastp', 'diamond'):
+            for thresholds in threshold_sets:
+                with self.subTest(program=program, **thresholds):
+                    options = alignment.get_prefilter_options(program, **thresholds)
+                    self.assertTrue(options)
+                    orthologs_expected = self.discover_orthologs(self.blastp_ref, self.blastp_iso, thresholds)
+                    blastp_ref = apply_prefilter_options(self.blastp_ref, options)
+                    blastp_iso = apply_prefilter_options(self.blastp_iso, options)
+                    self.assertLess(len(blastp_ref.hits), len(self.blastp_ref.hits))
+                    orthologs = self.discover_orthologs(blastp_ref, blastp_iso, thresholds)
+                    self.assertTrue(orthologs_expected)
+                    self.assertEqual(orthologs, orthologs_expected)
+
+    @staticmethod
+    def discover_orthologs(blastp_ref, blastp_iso, thresholds):
+        blastp_ref = alignment.filter_results(blastp_ref, **thresholds)
+        blastp_iso = alignment.filter_results(blastp_iso, **thresholds)
+        return draft_model.discover_orthologs(blastp_ref, blastp_iso)
+
+
+if __name__ == '__main__':
+    unittest.main()